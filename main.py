@@ -19,6 +19,7 @@ from tkinter import messagebox, filedialog, ttk
 from datetime import datetime, timedelta
 from threading import Lock, Thread
 from collections import OrderedDict
+from functools import partial
 
 #my modules
 import src.conf as conf
@@ -26,13 +27,14 @@ import src.sym as sym
 import src.coord as coord
 import src.util as util
 from src.ui import MapSelectFrame
-from src.gpx import GpsDocument, WayPoint, TrackPoint
+from src.gpx import GpsDocument, Track, WayPoint, TrackPoint
 from src.pic import PicDocument
-from src.util import GeoPoint, DrawGuard, imageIsTransparent, bindMenuCmdAccelerator, bindMenuCheckAccelerator
+from src.util import GeoPoint, DrawGuard, bindMenuCmdAccelerator, bindMenuCheckAccelerator
 from src.util import AreaSelector, AreaSizeTooLarge, GeoInfo  #should move to ui.py
-from src.util import downloadAsTemp, drawTextBg, subgroup, isValidFloat
+from src.util import downloadAsTemp, drawTextBg, subgroup, isValidFloat, clipSegment
 from src.common import fmtPtPosText, fmtPtEleText, fmtPtTimeText, fmtPtTimezone, fmtPtLocaltime, textToGeo
-from src.tile import TileAgent, MapDescriptor
+from src.tile import TileAgent, MapDescriptor, MemoryCache
+from src.compositor import compositeLayers
 from src.sym import askSym, toSymbol
 from src.raw import *
 
@@ -1339,6 +1341,15 @@ class MapAgent:
     def isRunning(self):
         return self.__tile_agent.state == TileAgent.ST_RUN
 
+    #tell the tile agent what is viewing, to prioritize or drop the tile requests
+    def setViewport(self, req_attr):
+        level = min(max(self.level_min, req_attr.level), self.level_max)
+        extra_p = self.__extra_p
+        if req_attr.level != level:
+            extra_p = self.__extra_p * 2**(level - req_attr.level)
+            req_attr = req_attr.zoomToLevel(level)
+        self.__tile_agent.setViewport(level, req_attr.boundTiles(extra_p))
+
     #todo: refine this to reduce repeat
     def __isCacheValid(self, req_attr):
         cache_map = self.__cache_basemap
@@ -1360,6 +1371,12 @@ class MapAgent:
 
         if req_attr.level == level:
             tile_map = self.__genTileMap(req_attr, self.__extra_p, req_type, cb)
+        elif 0 < level - req_attr.level <= TileAgent.REDUCED_MAX_SHIFT:
+            #zoom out, decode the tiles in the reduced size directly
+            aprx_attr = req_attr.zoomToLevel(level)
+            extra_p = self.__extra_p * 2**(level - req_attr.level)
+            aprx_map, aprx_attr = self.__genTileMap(aprx_attr, extra_p, req_type, cb, level - req_attr.level)
+            tile_map = (aprx_map, aprx_attr.zoomToLevel(req_attr.level))
         else:
             #get approx map
             aprx_attr = req_attr.zoomToLevel(level)
@@ -1408,19 +1425,6 @@ class MapAgent:
             return (t_left <= x <= t_right) and (t_upper <= y <= t_lower)
         return False
 
-    @classmethod
-    def isCompleteColor(cls, img):
-        extrema = img.getextrema()
-        #channels = min(len(extrema), 3)
-        if img.mode == "P":
-            _min, _max = extrema
-            return _min == _max
-        else:
-            for _min, _max in extrema:
-                if _min != _max:
-                    return False
-        return True
-
     def __notifyTileReady(self, level, x, y, cb):
         try:
             if cb is not None:
@@ -1435,7 +1439,8 @@ class MapAgent:
     '''
 
     #could return None map
-    def __genTileMap(self, map_attr, extra_p, req_type, cb=None):
+    #the map is reduced to 1/2**@shift, if @shift is not 0
+    def __genTileMap(self, map_attr, extra_p, req_type, cb=None, shift=0):
         async_cb = cb if cb is not None and req_type == "async" else None
         #if cb is not None and req_type == "async":
         #    async_cb = lambda level, x, y: self.__tileIsReady(level, x, y, map_attr, cb) 
@@ -1450,18 +1455,34 @@ class MapAgent:
 
         disp_map = None
         fail_tiles = 0
+        is_transparent = True  #all the tiles are transparent
+
+        tiles = self.__tile_agent.getReducedTiles(map_attr.level, range(t_left, t_right +1), range(t_upper, t_lower +1), shift, req_type, async_cb)
+        step = to_pixel(1, 1)[0] >> shift
 
         for x in range(tx_num):
             for y in range(ty_num):
-                tile = self.__tile_agent.getTile(map_attr.level, t_left +x, t_upper +y, req_type, async_cb)
+                tile = tiles[(t_left +x, t_upper +y)]
 
                 if tile is None or tile.is_fake:
                     fail_tiles += 1
 
                 if tile is not None:
                     if disp_map is None:
-                        disp_map = Image.new("RGBA", to_pixel(tx_num, ty_num), 'lightgray')
-                    disp_map.paste(tile, to_pixel(x, y))
+                        disp_map = Image.new("RGBA", (tx_num * step, ty_num * step), 'lightgray')
+                    #fill the blank and uniform tiles, without pasting the pixels
+                    kind = getattr(tile, 'tile_kind', TileAgent.KIND_MIXED)
+                    box = (x * step, y * step, (x+1) * step, (y+1) * step)
+                    if kind == TileAgent.KIND_TRANSPARENT:
+                        disp_map.paste((0, 0, 0, 0), box)
+                    elif kind == TileAgent.KIND_UNIFORM:
+                        disp_map.paste(tile.tile_color, box)
+                        is_transparent = False
+                    else:
+                        disp_map.paste(tile, box[:2])
+                        is_transparent = False
+                else:
+                    is_transparent = False
 
                 if req_type == "sync" and cb is not None:
                     tile_info = (self.map_id, map_attr.level, t_left + x, t_upper +y)
@@ -1469,6 +1490,10 @@ class MapAgent:
 
         logging.debug("pasting tile...done")
 
+        #nothing to combine with other maps
+        if is_transparent:
+            disp_map = None
+
         #reset map_attr
         pos = to_pixel(t_left, t_upper)
         size = to_pixel(tx_num, ty_num)
@@ -1476,8 +1501,83 @@ class MapAgent:
 
         return  (disp_map, disp_attr)
 
+    # the tiles of the map to composite the tiles in @bounds at @level, which may be out of the levels of the map:
+    # the reduced tiles of level_min are pasted to zoom out, and a tile of level_max is magnified to zoom in.
+    # return dict of (x, y) -> (sig, gen), where sig is the tile_seq of the source tiles, or None if any of them
+    # is missing or fake; gen() makes the 256x256 tile.
+    def genLayerTiles(self, level, bounds, req_type, cb=None):
+        async_cb = cb if cb is not None and req_type == "async" else None
+        t_left, t_upper, t_right, t_lower = bounds
+        src_level = min(max(self.level_min, level), self.level_max)
+        side = to_pixel(1, 1)[0]
+
+        layer_tiles = {}
+        if src_level >= level:
+            s = src_level - level
+            n, step = 1 << s, side >> s
+            tiles = self.__tile_agent.getReducedTiles(src_level, range(t_left * n, (t_right +1) * n),
+                    range(t_upper * n, (t_lower +1) * n), s, req_type, async_cb)
+            for x in range(t_left, t_right +1):
+                for y in range(t_upper, t_lower +1):
+                    srcs = [(p * step, q * step, tiles[(x * n + p, y * n + q)]) for p in range(n) for q in range(n)]
+                    layer_tiles[(x, y)] = (self.__genTileSig(srcs), partial(self.__pasteTiles, srcs, side))
+        else:
+            s = level - src_level
+            n, step = 1 << s, side / (1 << s)
+            tiles = self.__tile_agent.getTiles(src_level, range(t_left >> s, (t_right >> s) +1),
+                    range(t_upper >> s, (t_lower >> s) +1), req_type, async_cb)
+            for x in range(t_left, t_right +1):
+                for y in range(t_upper, t_lower +1):
+                    tile = tiles[(x >> s, y >> s)]
+                    left, upper = (x % n) * step, (y % n) * step
+                    srcs = [(0, 0, tile)]
+                    layer_tiles[(x, y)] = (self.__genTileSig(srcs),
+                            partial(self.__magnifyTile, tile, (left, upper, left + step, upper + step), side))
+        return layer_tiles
+
+    @classmethod
+    def __genTileSig(cls, srcs):
+        sig = []
+        for left, upper, tile in srcs:
+            if tile is None or tile.is_fake:
+                return None
+            sig.append(tile.tile_seq)
+        return tuple(sig)
+
+    #paste the tiles [(left, upper, tile), ...] as the map is pasted by __genTileMap
+    @classmethod
+    def __pasteTiles(cls, srcs, side):
+        if len(srcs) == 1 and srcs[0][2] is not None:
+            return srcs[0][2]
+
+        img = Image.new("RGBA", (side, side), 'lightgray')
+        for left, upper, tile in srcs:
+            if tile is None:
+                continue
+            kind = getattr(tile, 'tile_kind', TileAgent.KIND_MIXED)
+            box = (left, upper) + tuple(v + tile.size[0] for v in (left, upper))
+            if kind == TileAgent.KIND_TRANSPARENT:
+                img.paste((0, 0, 0, 0), box)
+            elif kind == TileAgent.KIND_UNIFORM:
+                img.paste(tile.tile_color, box)
+            else:
+                img.paste(tile, box[:2])
+        return img
+
+    #magnify the @box of the tile to the whole tile
+    @classmethod
+    def __magnifyTile(cls, tile, box, side):
+        if tile is None:
+            return Image.new("RGBA", (side, side), 'lightgray')
+        if getattr(tile, 'tile_kind', TileAgent.KIND_MIXED) != TileAgent.KIND_MIXED:
+            return tile  #the same color all over
+        if tile.mode not in ("RGB", "RGBA"):
+            tile = tile.convert("RGBA")  #not to resize the palette by the nearest
+        return tile.resize((side, side), Image.BILINEAR, box=box)
+
 # todo: what is the class's purpose?, suggest to reconsider
 class MapController:
+    COMPOSITE_MAX_SHIFT = 3  #the levels below level_min of a map to composite by tiles, and by the whole view beyond
 
     #{{ properties
     @property
@@ -1510,7 +1610,9 @@ class MapController:
     def is_hide_text(self): return self.__is_hide_text
 
     @is_hide_text.setter
-    def is_hide_text(self, v): self.__is_hide_text = v
+    def is_hide_text(self, v):
+        self.__is_hide_text = v
+        self.__invalidateOverlay()
 
     def __init__(self, parent):
         #def settings
@@ -1523,6 +1625,11 @@ class MapController:
         #image
         self.__cache_gpsmap = None
         self.__cache_attr = None
+        self.__cache_basemap = None      #the maps composited
+        self.__cache_baseattr = None
+        self.__cache_overlay = None      #the tracks and waypoints over the transparent, None if nothing
+        self.__cache_overlay_attr = None
+        self.__composite_cache = MemoryCache(TileAgent.TILE_NOT_IN_MEM, is_concurrency=True, max_bytes=conf.MEM_COMPOSITE_CACHE_SIZE)
         self.__font = conf.IMG_FONT
         self.__is_hide_text = False
 
@@ -1551,6 +1658,8 @@ class MapController:
         self.__map_descs = descs
         self.__cache_gpsmap = None
         self.__cache_attr = None
+        self.__cache_basemap = None
+        self.__cache_baseattr = None
 
     #Are there any map contains the point?
     def mapContainsPt(self, geo):
@@ -1567,6 +1676,7 @@ class MapController:
 
     def addGpxLayer(self, gpx):
         self.__gpx_layers.append(gpx)
+        self.__invalidateOverlay()
 
     def genTrk(self):
         def_name = "TRK-" + str(len(self.__pseudo_gpx.tracks) + 1)
@@ -1577,23 +1687,28 @@ class MapController:
             if trk in gpx.tracks:
                 gpx.tracks.remove(trk)
                 break
+        self.__invalidateOverlay()
 
     def addTrkpt(self, trk_idx, pt):
         self.__pseudo_gpx.addTrkpt(trk_idx, pt)
+        self.__invalidateOverlay()
 
     def addWpt(self, wpt):
         self.__pseudo_gpx.addWpt(wpt)
+        self.__invalidateOverlay()
 
     def addMark(self, geo):
         wpt = WayPoint(geo.lat, geo.lon)
         wpt.sym = 'crosshair'
         self.__mark_wpt = wpt
+        self.__invalidateOverlay()
 
     def deleteWpt(self, wpt):
         for gpx in self.__gpx_layers:
             if wpt in gpx.way_points:
                 gpx.way_points.remove(wpt)
                 break
+        self.__invalidateOverlay()
 
     def getAllWpts(self):
         wpts = []
@@ -1626,6 +1741,9 @@ class MapController:
 
         #The image attributes with which we want to create a image compatible.
         req_attr = MapAttr(level, (px, py), (width, height), 0)
+        if req_type == "async":
+            for agent in self.__getMapAgents():
+                agent.setViewport(req_attr)
         map, attr = self.__genGpsMap(req_attr, force, req_type, cb)
 
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  crop map")
@@ -1637,58 +1755,12 @@ class MapController:
         req_attr.fail_tiles = attr.fail_tiles
         return map, req_attr
 
-    def __isCacheValid(self, cache_map, req_attr):
-        cache_attr = self.__cache_attr
+    def __isCacheValid(self, cache_map, cache_attr, req_attr):
         return cache_map and \
                cache_attr and \
                cache_attr.fail_tiles == 0 and \
                cache_attr.coversArea(req_attr)
 
-    @classmethod
-    def __combinePixel(cls, p, q, alpha):
-        beta = 255 - alpha
-        return ((p[0]*beta + q[0]*alpha) >> 8,
-                (p[1]*beta + q[1]*alpha) >> 8,
-                (p[2]*beta + q[2]*alpha) >> 8,
-                255)
-
-    @classmethod
-    #tune alpha channel by @alpha, which between 0.0~1.0
-    def tunealpha(cls, img, alpha):
-        logging.debug("prepare to tune alpha...")
-        if img.mode != "RGBA":
-            logging.warning("not support mode '%s' to tune alpha" % (img.mode,))
-            return
-
-        alpha = int(alpha*256)
-
-        #optimize
-        min_a, max_a = img.getextrema()[3];
-        if alpha == 256 or max_a == 0:
-            return img
-        if alpha == 0 or min_a == 255:
-            img.putalpha(alpha)
-            return img
-
-        logging.debug("start to tune alpha...")
-
-        bands = img.split()
-
-        #tune alpha channel
-        #todo: for improve, may use numpy module
-        data = bands[3].load()
-        w, h = img.size
-        for x in range(w):
-            for y in range(h):
-                p = data[x,y]
-                if p:
-                    data[x,y] = (p * alpha) >> 8
-
-        result = Image.merge("RGBA", bands)
-
-        logging.debug("end to tune alpha...")
-        return result
-
     def __getMapAgents(self):
         agents = []
         for desc in self.__map_descs:
@@ -1710,13 +1782,36 @@ class MapController:
 
         return agents
 
-    def __runReqMap(self, repo, repo_lock, agent, req_attr, req_type, cb):
+    def __runReqMap(self, repo, repo_lock, agent, gen):
         logging.debug('generating map: %s', (agent.map_id,))
-        res = agent.genMap(req_attr, req_type, cb)
+        res = gen(agent)
         logging.debug('generated map: %s', (agent.map_id,))
         with repo_lock:
             repo[agent] = res
 
+    #return [gen(agent), ...] of the @agents, which run concurrently if async
+    def __runAgents(self, agents, gen, req_type):
+        # sync to get maps
+        if len(agents) == 1 or req_type == 'sync':
+            return [gen(agent) for agent in agents]
+
+        # Async to get maps
+        map_repo = {}
+        map_repo_lock = Lock()
+        map_workers = []
+
+        #create req map workers
+        for agent in agents:
+            worker = Thread(target=self.__runReqMap, args=(map_repo, map_repo_lock, agent, gen))
+            worker.start()
+            map_workers.append(worker)
+
+        #wait all workers done
+        for worker in map_workers:
+            worker.join()
+
+        return [map_repo[agent] for agent in agents]
+
     def __getMaps(self, req_attr, req_type, cb=None):
         agents = self.__getMapAgents()
 
@@ -1724,36 +1819,10 @@ class MapController:
             return None
 
         maps = []
-        
-        # sync to get maps
-        if len(agents) == 1 or req_type == 'sync':
-            for agent in agents:
-                map, attr = agent.genMap(req_attr, req_type, cb)
-                maps.append((map, attr, agent.alpha))
-        # Async to get maps
-        else:
-            map_repo = {}
-            map_repo_lock = Lock()
-            map_workers = []
-
-            #create req map workers
-            for agent in agents:
-                job = lambda: self.__runReqMap(map_repo, map_repo_lock, agent, req_attr, req_type, cb)
-                worker = Thread(target=job)
-                worker.start()
-                map_workers.append(worker)
-
-            #wait all workers done
-            for worker in map_workers:
-                worker.join()
-
-            #collectin maps
-            idx = 0
-            for agent in agents:
-                map, attr = map_repo[agent]
-                maps.append((map, attr, agent.alpha))
-                logging.debug('get map[%d] %-20s, size: %s, attr: %s' % (idx, agent.map_id, "None" if map is None else str(map.size), str(attr)))
-                idx += 1
+        results = self.__runAgents(agents, lambda agent: agent.genMap(req_attr, req_type, cb), req_type)
+        for idx, (agent, (map, attr)) in enumerate(zip(agents, results)):
+            maps.append((map, attr, agent.alpha))
+            logging.debug('get map[%d] %-20s, size: %s, attr: %s' % (idx, agent.map_id, "None" if map is None else str(map.size), str(attr)))
 
         return maps
 
@@ -1767,19 +1836,66 @@ class MapController:
                 logging.warning("[NeedCropMap] map[%d]: %s" % (i, str(attrs[i])))
                 logging.warning("[NeedCropMap]      -> %s" % (str(baseattr)))
 
-    #alpha between 0.0~1.0
-    @classmethod
-    def combineMap(cls, basemap, map, alpha):
-        if imageIsTransparent(map):
-            if alpha != 1.0:
-                map = cls.tunealpha(map, alpha)
-            return Image.alpha_composite(basemap, map)
-        else:
-            if alpha != 1.0:
-                return Image.blend(basemap, map, alpha)
-            return map
+    #composite by tiles, unless the view is saved (sync) or some map is zoomed out too far
+    def __isCompositeByTiles(self, agents, req_attr, req_type):
+        return agents and req_type == "async" and \
+               all(agent.level_min - req_attr.level <= self.COMPOSITE_MAX_SHIFT for agent in agents)
+
+    # the composited tile of the @layer_tiles, [((sig, gen), alpha), ...] from the top to the bottom.
+    # the tile is cached by the @stack of the maps, and valid until the source tiles of any map change.
+    # return (tile, is_ready)
+    def __getCompositeTile(self, level, x, y, stack, layer_tiles):
+        id = "%s/%d/%d/%d" % (stack, level, x, y)
+        sigs = tuple(sig for (sig, gen), alpha in layer_tiles)
+        is_ready = None not in sigs
+
+        img = self.__composite_cache.get(id)[0]
+        if img is not None and is_ready and img.composite_sigs == sigs:
+            return img, True
+
+        layers = []
+        for (sig, gen), alpha in reversed(layer_tiles):
+            tile = gen()
+            if getattr(tile, 'tile_kind', TileAgent.KIND_MIXED) != TileAgent.KIND_TRANSPARENT:
+                layers.append((tile, alpha))
+        side = to_pixel(1, 1)[0]
+        img = compositeLayers((side, side), layers)
+
+        if is_ready:
+            img.composite_sigs = sigs
+            self.__composite_cache.set(id, TileAgent.TILE_VALID, img)
+        return img, is_ready
+
+    #paste the composited tiles of the view, which only composites the tiles not in cache
+    def __genCompositeMap(self, agents, req_attr, req_type, cb=None):
+        level = req_attr.level
+        bounds = req_attr.boundTiles(0)
+        t_left, t_upper, t_right, t_lower = bounds
+        tx_num = t_right - t_left +1
+        ty_num = t_lower - t_upper +1
+
+        layers = self.__runAgents(agents, lambda agent: agent.genLayerTiles(level, bounds, req_type, cb), req_type)
+        alphas = [agent.alpha for agent in agents]
+        stack = ",".join("%s:%g" % (agent.map_id, agent.alpha) for agent in agents)
+
+        side = to_pixel(1, 1)[0]
+        basemap = Image.new("RGBA", to_pixel(tx_num, ty_num))
+        fail_tiles = 0
+        for x in range(t_left, t_right +1):
+            for y in range(t_upper, t_lower +1):
+                layer_tiles = [(layer[(x, y)], alpha) for layer, alpha in zip(layers, alphas)]
+                tile, is_ready = self.__getCompositeTile(level, x, y, stack, layer_tiles)
+                if not is_ready:
+                    fail_tiles += 1
+                basemap.paste(tile, ((x - t_left) * side, (y - t_upper) * side))
+
+        baseattr = MapAttr(level, to_pixel(t_left, t_upper), to_pixel(tx_num, ty_num), fail_tiles)
+        return basemap, baseattr
 
     def __genBaseMap(self, req_attr, req_type, cb=None):
+        agents = self.__getMapAgents()
+        if self.__isCompositeByTiles(agents, req_attr, req_type):
+            return self.__genCompositeMap(agents, req_attr, req_type, cb)
 
         maps = self.__getMaps(req_attr, req_type, cb)
 
@@ -1796,34 +1912,60 @@ class MapController:
 
             self.__checkAttrs(attrs, baseattr)
 
-        #create basemap
-        basemap = Image.new("RGBA", baseattr.size, "white")
+        #create basemap, by all the layers at once
+        layers = []
         if maps:
             for map, attr, alpha in reversed(maps):
                 if map is None:
                     continue
-                cropmap = self.__genCropMap(map, attr, baseattr)
-                basemap = self.combineMap(basemap, cropmap, alpha)
+                layers.append((self.__genCropMap(map, attr, baseattr), alpha))
+        basemap = compositeLayers(baseattr.size, layers)
 
         return basemap, baseattr
 
+    def __invalidateOverlay(self):
+        self.__cache_overlay = None
+        self.__cache_overlay_attr = None
+
+    # the base map and the overlay are cached apart:
+    # the base map is re-generated if the maps change (force == 'all'), or some tiles are not ready;
+    # the overlay is re-drawn if the gpx is altered (force == 'gps', 'trk', 'wpt'), or the area is out of it.
     def __genGpsMap(self, req_attr, force=None, req_type="async", cb=None):
-        if force not in ('all', 'gps', 'trk', 'wpt') and self.__isCacheValid(self.__cache_gpsmap, req_attr):
+        if force not in ('all', 'gps', 'trk', 'wpt') and self.__cache_overlay_attr is not None and \
+                self.__isCacheValid(self.__cache_gpsmap, self.__cache_attr, req_attr):
             #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  get gps map from cache")
             return (self.__cache_gpsmap, self.__cache_attr)
 
-        basemap, attr = self.__genBaseMap(req_attr, req_type, cb)
+        if force == 'all' or not self.__isCacheValid(self.__cache_basemap, self.__cache_baseattr, req_attr):
+            self.__cache_basemap, self.__cache_baseattr = self.__genBaseMap(req_attr, req_type, cb)
+        basemap, attr = self.__cache_basemap, self.__cache_baseattr
+
+        overlay_attr = self.__cache_overlay_attr
+        if force in ('all', 'gps', 'trk', 'wpt') or overlay_attr is None or not overlay_attr.coversArea(attr):
+            #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  draw gpx")
+            self.__cache_overlay = self.__genOverlay(attr)
+            self.__cache_overlay_attr = overlay_attr = attr.clone()
 
         #create gpsmap, also cache
-        self.__cache_gpsmap = basemap.copy()
+        if self.__cache_overlay is None:
+            self.__cache_gpsmap = basemap.copy()
+        else:
+            overlay = self.__genCropMap(self.__cache_overlay, overlay_attr, attr)
+            self.__cache_gpsmap = Image.alpha_composite(basemap, overlay)
         self.__cache_attr = attr
-        #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  draw trk")
-        self.__drawTrk(self.__cache_gpsmap, attr)
-        #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  draw wpt")
-        self.__drawWpt(self.__cache_gpsmap, attr)
 
         return self.__cache_gpsmap, self.__cache_attr
 
+    #draw the tracks and waypoints over the transparent, or return None if nothing to draw
+    def __genOverlay(self, attr):
+        if not self.getAllTrks() and not self.getAllWpts() and self.__mark_wpt is None:
+            return None
+
+        overlay = Image.new("RGBA", attr.size, (0, 0, 0, 0))
+        self.__drawTrk(overlay, attr)
+        self.__drawWpt(overlay, attr)
+        return overlay
+
     def __drawTrk(self, map, map_attr):
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "draw gpx...")
         if not self.__gpx_layers:
@@ -1864,30 +2006,69 @@ class MapController:
                 _draw.ellipse((px-r, py-r, px+r, py+r), fill=color, outline=bg_color)
             else:
                 #print('draw trk seg')
-                xy = []
-                for pt in pts:
-                    (px, py) = pt.pixel(map_attr.level)
-                    xy.append(px - map_attr.left_px)
-                    xy.append(py - map_attr.up_py)
+                #the points at the same pixel draw nothing more
+                if isinstance(pts, Track):
+                    pts = pts.getSimplified(map_attr.level)
+                else:
+                    pts = Track.simplifyPoints(pts, map_attr.level)
+
+                w, h = map.size
+                runs = self.__clipTrkRuns(pts, map_attr, (-bg_width, -bg_width, w + bg_width, h + bg_width))
 
                 if bg_color is not None:
-                    _draw.line(xy, fill=bg_color, width=width+4)
+                    for xy in runs:
+                        _draw.line(xy, fill=bg_color, width=width+4)
 
-                _draw.line(xy, fill=color, width=width)
+                for xy in runs:
+                    _draw.line(xy, fill=color, width=width)
         finally:
             if draw is None:
                 del _draw
 
+    # the runs of the consecutive segments of @pts crossing the @rect, in pixels of the image,
+    # return [[x0, y0, x1, y1, ...], ...]
+    @classmethod
+    def __clipTrkRuns(cls, pts, map_attr, rect):
+        left, upper, right, lower = rect
+        runs = []
+        xy = None   #the current run
+        prev = None
+        level, left_px, up_py = map_attr.level, map_attr.left_px, map_attr.up_py
+        for pt in pts:
+            (px, py) = pt.pixel(level)
+            px -= left_px
+            py -= up_py
+
+            if prev is not None:
+                x0, y0 = prev
+                if (px < left and x0 < left) or (px > right and x0 > right) or \
+                        (py < upper and y0 < upper) or (py > lower and y0 > lower):
+                    is_visible = False  #both at the outside of an edge
+                else:
+                    is_visible = (left <= px <= right and upper <= py <= lower) or \
+                                 (left <= x0 <= right and upper <= y0 <= lower) or \
+                                 clipSegment(x0, y0, px, py, rect) is not None
+                if not is_visible:
+                    xy = None
+                elif xy is None:
+                    xy = [x0, y0, px, py]
+                    runs.append(xy)
+                else:
+                    xy.extend((px, py))
+            prev = (px, py)
+        return runs
+
 
     def isTrackInImage(self, trk, map_attr):
-        """Currently disabled, 'cause the algo will be broken if two pt across the image"""
-        return True
-        #if some track point is in disp
-        # for pt in trk:
-        #     (px, py) = pt.pixel(map_attr.level)
-        #     if map_attr.coversPoint(px, py):
-        #         return True
-        # return False
+        """if the bounds of the track overlap the image, with the margin of the line width"""
+        if trk.maxlat is None:
+            return False
+
+        left, upper = GeoPoint(lat=trk.maxlat, lon=trk.minlon).pixel(map_attr.level)
+        right, lower = GeoPoint(lat=trk.minlat, lon=trk.maxlon).pixel(map_attr.level)
+        margin = conf.TRK_WIDTH + 4
+        return left - margin <= map_attr.right_px and right + margin >= map_attr.left_px and \
+               upper - margin <= map_attr.low_py and lower + margin >= map_attr.up_py
 
     def __drawWpt(self, map, map_attr):
         """draw pic as waypoint"""
@@ -1909,7 +2090,11 @@ class MapController:
 
     @classmethod
     def pasteTransparently(cls, img, img2, pos=(0,0), errmsg=None):
-        if img2.mode == 'RGBA':
+        if img.mode == 'RGBA' and (img2.mode in ('RGBA', 'LA') or (img2.mode == 'P' and 'transparency' in img2.info)):
+            #composite over, which also keeps the alpha right if img is transparent, as the gpx overlay
+            x, y = pos
+            img.alpha_composite(img2.convert('RGBA'), (max(0, x), max(0, y)), (max(0, -x), max(0, -y)))
+        elif img2.mode == 'RGBA':
             img.paste(img2, pos, img2)
         elif img2.mode == 'LA' or (img2.mode == 'P' and 'transparency' in img2.info):
             mask = img2.convert('RGBA')
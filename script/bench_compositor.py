@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+""" benchmark the layer compositor against the per-layer combining it replaced.
+    ex: bench_compositor.py --size 1920 1080 --repeat 3 """
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from src.compositor import compositeLayers
+from src.util import imageIsTransparent
+
+#the former MapController.tunealpha and MapController.combineMap, as the reference
+def legacyTuneAlpha(img, alpha):
+    alpha = int(alpha*256)
+
+    min_a, max_a = img.getextrema()[3]
+    if alpha == 256 or max_a == 0:
+        return img
+    if alpha == 0 or min_a == 255:
+        img.putalpha(alpha)
+        return img
+
+    bands = img.split()
+    data = bands[3].load()
+    w, h = img.size
+    for x in range(w):
+        for y in range(h):
+            p = data[x,y]
+            if p:
+                data[x,y] = (p * alpha) >> 8
+    return Image.merge("RGBA", bands)
+
+def legacyCombineMap(basemap, map, alpha):
+    if imageIsTransparent(map):
+        if alpha != 1.0:
+            map = legacyTuneAlpha(map, alpha)
+        return Image.alpha_composite(basemap, map)
+    else:
+        if alpha != 1.0:
+            return Image.blend(basemap, map, alpha)
+        return map
+
+def legacyComposite(size, layers):
+    basemap = Image.new("RGBA", size, "white")
+    for img, alpha in layers:
+        basemap = legacyCombineMap(basemap, img.copy(), alpha)
+    return basemap
+
+#a base map, a semi-transparent overlay covering a part of the view, and a translucent opaque overlay
+def genLayers(size):
+    w, h = size
+    rand = np.random.RandomState(0)
+
+    base = rand.randint(0, 256, (h, w, 3), dtype=np.uint8)
+    base = Image.fromarray(np.dstack((base, np.full((h, w), 255, np.uint8))), "RGBA")
+
+    sparse = np.zeros((h, w, 4), np.uint8)
+    part = sparse[h//4 : h*3//4, w//4 : w*3//4]
+    part[..., :3] = rand.randint(0, 256, part[..., :3].shape, dtype=np.uint8)
+    part[::2, :, 3] = 200
+    sparse = Image.fromarray(sparse, "RGBA")
+
+    gray = Image.fromarray(rand.randint(0, 256, (h, w), dtype=np.uint8), "L")
+    return [(base, 1.0), (sparse, 0.7), (gray.convert("RGBA"), 0.4)]
+
+def bench(func, size, layers, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        img = func(size, layers)
+        elapsed = time.time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return img, best
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Benchmark the layer compositor.")
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080), metavar=('W', 'H'))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-legacy', action='store_true', help="skip the legacy combining, which takes seconds")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parseArgs()
+    size = tuple(args.size)
+    layers = genLayers(size)
+
+    img, elapsed = bench(compositeLayers, size, layers, args.repeat)
+    print("compositor: %.3fs" % (elapsed,))
+
+    if not args.no_legacy:
+        legacy_img, legacy_elapsed = bench(legacyComposite, size, layers, 1)
+        diff = np.abs(np.asarray(img, np.int16) - np.asarray(legacy_img, np.int16)).max()
+        print("legacy:     %.3fs, %.1fx, max diff %d" % (legacy_elapsed, legacy_elapsed / elapsed, diff))
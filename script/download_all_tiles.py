@@ -1,98 +1,65 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import sys
-sys.path.insert(0, 'src')
-
-import tile
-from tile import TileSystem
+""" download the tiles of an area to the local cache of a map, resumable.
+    ex: download_all_tiles.py TM25K_2001 --levels 7 16 --bbox 21.876792 25.373809 120.020142 122.025146 """
 
-import urllib.request
-import shutil
-import threading
-from threading import Thread, Lock
-import time
 import os
-
-CACHE_DIR = "mapcache"
-MAX_THREAD = 5
-thread_lock = Lock()
-thread_pool = []
-
-def downloadJob(tile_map, level, x, y):
-    #do download
-    result_ok = False
-    try:
-        url = tile_map.genTileUrl(level, x, y)
-        path = tile_map.genTilePath(level, x, y)
-        print('DL', url)
-        with urllib.request.urlopen(url, timeout=30) as response:
-            tile.mkdirCheck(os.path.dirname(path))
-            with open(path, 'wb') as f:
-                shutil.copyfileobj(response, f)
-        result_ok = True
-    except Exception as ex:
-        print('ERROR download %s to %s error: %s' % (url, path, str(ex)))
-
-    #result
-    print('DL %s [%s]' % (url, 'SUCCESS' if result_ok else 'FAILED'))
-
-    #remove from pool
-    myself = threading.current_thread()
-    with thread_lock:
-        thread_pool.remove(myself)
-
-def downloadArea(map, low_lat, up_lat, left_lon, right_lon):
-    #level
-    for level in range(map.level_min, map.level_max+1):
-        #x, y
-        min_x, min_y = TileSystem.getTileXYByLatLon(up_lat, left_lon, level)
-        max_x, max_y = TileSystem.getTileXYByLatLon(low_lat, right_lon, level)
-        total = (max_x - min_x + 1) * (max_y - min_y + 1)
-        print("Download Tiles in level %d, X,Y=(%d->%d, %d->%d), total %d tiles" % (level, min_x, max_x, min_y, max_y, total))
-
-        count = 0
-        for x in range(min_x, max_x+1):
-            for y in range(min_y, max_y+1):
-                count += 1
-                #check
-                path = map.genTilePath(level, x, y)
-                if os.path.exists(path) and os.path.getsize(path):
-                    #print("SKIP tile(%d,%d,%d)...%d/%d" % (level, x, y, count, total))
-                    continue
-
-                #wait thread_pool available
-                while True:
-                    with thread_lock:
-                        if len(thread_pool) < MAX_THREAD:
-                            break
-                    print('.', end='')
-                    time.sleep(1)
-
-                #download
-                print("DL tile(%d,%d,%d)...%d/%d" % (level, x, y, count, total))
-                job = lambda: downloadJob(map, level, x, y)
-                th = Thread(target=job)
-                with thread_lock:
-                    thread_pool.append(th)
-                th.start()
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import logging
+
+import src.conf as conf
+from src.tile import MapDescriptor
+from src.seed import TileSeeder, bboxToPolygon
+from src.util import readPolygon
+
+def loadMapDescriptor(map_name, cache_dir):
+    path = map_name if map_name.endswith('.xml') else os.path.join(cache_dir, map_name + '.xml')
+    if not os.path.exists(path):
+        raise ValueError("map descriptor '%s' not found" % (path,))
+    return MapDescriptor.parseXml(path)
+
+def showProgress(state, tiles_per_sec):
+    print("level %d row %d: done %d, cached %d, failed %d, %.1f tiles/s" % \
+            (state['level'], state['row'], state['done'], state['cached'], state['failed'], tiles_per_sec))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Download the tiles of an area to the local cache of a map.")
+    parser.add_argument('map', help="the map id in the cache dir, or the path of the map descriptor")
+    parser.add_argument('--cache-dir', default=conf.MAPCACHE_DIR, help="the local cache dir (default: %(default)s)")
+    parser.add_argument('--levels', type=int, nargs=2, metavar=('MIN', 'MAX'), help="the levels to download (default: all levels of the map)")
+    area = parser.add_mutually_exclusive_group(required=True)
+    area.add_argument('--bbox', type=float, nargs=4, metavar=('LOW_LAT', 'UP_LAT', 'LEFT_LON', 'RIGHT_LON'))
+    area.add_argument('--polygon', metavar='FILE', help="a text file of the polygon, one 'lat,lon' each line")
+    parser.add_argument('--works', type=int, help="the concurrent downloads (default: from the map or the app settings)")
+    parser.add_argument('--state', metavar='FILE', help="the file to save the progress (default: <cache-dir>/<map id>.seed.json)")
+    parser.add_argument('--restart', action='store_true', help="ignore the saved progress; the cached tiles are still skipped, to retry the failed tiles")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args()
 
 if __name__ == '__main__':
-    cdir = sys.argv[1] if len(sys.argv) > 1 else CACHE_DIR
+    args = parseArgs()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
 
-    #TM25Kv3
-    map = tile.getTM25Kv3TileMap(cache_dir=cdir)
     try:
-        #main island of Taiwan
-        low_lat, up_lat = 21.876792, 25.373809
-        left_lon, right_lon = 120.020142, 122.025146
-        downloadArea(map, low_lat, up_lat, left_lon, right_lon)
+        desc = loadMapDescriptor(args.map, args.cache_dir)
+        polygon = readPolygon(args.polygon) if args.polygon else bboxToPolygon(*args.bbox)
+        level_min, level_max = args.levels if args.levels else (desc.level_min, desc.level_max)
+        state_path = args.state if args.state else os.path.join(args.cache_dir, desc.map_id + '.seed.json')
 
-        #penghu
-        low_lat, up_lat = 23.122995, 23.877676
-        left_lon, right_lon = 119.383106, 119.758186
-        downloadArea(map, low_lat, up_lat, left_lon, right_lon)
-    finally:
-        map.close()
+        seeder = TileSeeder(desc, args.cache_dir, polygon, level_min, level_max,
+                state_path=state_path, max_works=args.works, is_restart=args.restart)
+    except (ValueError, IOError) as ex:
+        sys.exit("Error: %s" % (str(ex),))
 
+    try:
+        is_finished = seeder.run(showProgress)
+    except KeyboardInterrupt:
+        is_finished = False
 
+    state = seeder.state
+    print("%s: done %d, cached %d, failed %d, skipped %d" % \
+            ('Finished' if is_finished else 'Stopped, run again to resume', state['done'], state['cached'], state['failed'], state.get('skipped', 0)))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+""" maintain the mbtiles files of the local cache: stats, purge the expired, evict to a quota, vacuum,
+    migrate to the dedup layout.
+    ex: maintain_cache.py stats
+        maintain_cache.py evict --quota 2G
+        maintain_cache.py purge TM25K_2001 && maintain_cache.py vacuum TM25K_2001 """
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import logging
+import time
+
+import src.conf as conf
+from src.tile import MapDescriptor, DBDiskCache
+
+def parseSize(text):
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def formatSize(n):
+    for unit in ('B', 'K', 'M', 'G'):
+        if n < 1024:
+            return "%.1f%s" % (n, unit) if unit != 'B' else "%d%s" % (n, unit)
+        n /= 1024.0
+    return "%.1fT" % (n,)
+
+def loadMapDescriptors(cache_dir, map_ids):
+    if not map_ids:
+        map_ids = sorted(os.path.splitext(f)[0] for f in os.listdir(cache_dir) if f.endswith('.mbtiles'))
+
+    descs = []
+    for map_id in map_ids:
+        path = os.path.join(cache_dir, map_id + '.xml')
+        if not os.path.exists(path):
+            logging.warning("map descriptor '%s' not found, skip the map" % (path,))
+            continue
+        if not os.path.exists(os.path.join(cache_dir, map_id + '.mbtiles')):
+            logging.warning("no cache of the map '%s', skip the map" % (map_id,))
+            continue
+        descs.append(MapDescriptor.parseXml(path))
+    return descs
+
+#only the 'migrate' command migrates the caches to the dedup layout, which takes long for a large cache
+def openCache(cache_dir, desc, is_migrating=False):
+    cache = DBDiskCache(cache_dir, desc, conf.DB_SCHEMA, is_concurrency=False)
+    cache.start(is_indexing=False, is_migrating=is_migrating)
+    return cache
+
+def showStats(caches):
+    total_count = total_bytes = total_file = 0
+    for desc, cache in caches:
+        stats = cache.getStats()
+        count = sum(n for level, n, size in stats)
+        file_bytes = cache.getFileBytes()
+        print("%s: %d tiles, %s data, %s stored, %s file" % (desc.map_id, count,
+                formatSize(sum(size or 0 for level, n, size in stats)), formatSize(cache.getStoredBytes()), formatSize(file_bytes)))
+        for level, n, size in stats:
+            print("    level %2d: %9d tiles, %s" % (level, n, formatSize(size or 0)))
+        total_count += count
+        total_bytes += cache.getStoredBytes()
+        total_file += file_bytes
+    print("Total: %d tiles, %s stored, %s file" % (total_count, formatSize(total_bytes), formatSize(total_file)))
+
+def purgeExpired(caches):
+    for desc, cache in caches:
+        if not desc.expire_sec:
+            print("%s: no expireDays, skipped" % (desc.map_id,))
+            continue
+        print("%s: purged %d tiles" % (desc.map_id, cache.purgeExpired(desc.expire_sec)))
+
+# the begin time of the buckets to keep, which sum up to @quota at most
+def findCutoff(histogram, quota):
+    kept = 0
+    for bucket in sorted(histogram, reverse=True):  #the latest first
+        kept += histogram[bucket]
+        if kept > quota:
+            return bucket + DBDiskCache.ACCESS_BUCKET
+    return None
+
+def evictToQuota(caches, quota, is_per_map):
+    groups = [[item] for item in caches] if is_per_map else [caches]
+    for group in groups:
+        histogram = {}
+        for desc, cache in group:
+            for bucket, size in cache.getAccessHistogram().items():
+                histogram[bucket] = histogram.get(bucket, 0) + size
+
+        cutoff = findCutoff(histogram, quota)
+        for desc, cache in group:
+            count = cache.evictBefore(cutoff) if cutoff is not None else 0
+            print("%s: evicted %d tiles%s" % (desc.map_id, count,
+                    (", not accessed since %s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(cutoff))) if count else ""))
+
+def vacuum(caches, max_pages):
+    for desc, cache in caches:
+        print("%s: reclaimed %d pages, %s file" % (desc.map_id, cache.vacuum(max_pages), formatSize(cache.getFileBytes())))
+
+def showLayout(caches):
+    for desc, cache in caches:
+        print("%s: %s layout, %s stored, %s file" % (desc.map_id, "dedup" if cache.isDedup() else "flat",
+                formatSize(cache.getStoredBytes()), formatSize(cache.getFileBytes())))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Maintain the mbtiles files of the local cache.")
+    parser.add_argument('--cache-dir', default=conf.MAPCACHE_DIR, help="the local cache dir (default: %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    cmds = parser.add_subparsers(dest='cmd', metavar='command')
+    cmds.required = True
+
+    cmd = cmds.add_parser('stats', help="show the tiles and the bytes per map and per level")
+    cmd.add_argument('maps', nargs='*', help="the map ids (default: all maps in the cache dir)")
+
+    cmd = cmds.add_parser('purge', help="delete the tiles older than the expireDays of the map")
+    cmd.add_argument('maps', nargs='*', help="the map ids (default: all maps in the cache dir)")
+
+    cmd = cmds.add_parser('evict', help="delete the least recently used tiles to meet the quota")
+    cmd.add_argument('maps', nargs='*', help="the map ids (default: all maps in the cache dir)")
+    cmd.add_argument('--quota', type=parseSize, required=True, help="the size of the tile data to keep, ex: 500M, 2G")
+    cmd.add_argument('--per-map', action='store_true', help="the quota is of each map, rather than of all the maps")
+
+    cmd = cmds.add_parser('vacuum', help="reclaim the free pages of the files")
+    cmd.add_argument('maps', nargs='*', help="the map ids (default: all maps in the cache dir)")
+    cmd.add_argument('--pages', type=int, default=0, help="the pages to reclaim of a map, 0 for all (default: %(default)s)")
+
+    cmd = cmds.add_parser('migrate', help="migrate the caches to the dedup layout, if db_dedup is set")
+    cmd.add_argument('maps', nargs='*', help="the map ids (default: all maps in the cache dir)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parseArgs()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    try:
+        if args.cmd == 'migrate' and not conf.DB_DEDUP:
+            raise ValueError("db_dedup is not set in the app conf")
+        descs = loadMapDescriptors(args.cache_dir, args.maps)
+        caches = [(desc, openCache(args.cache_dir, desc, args.cmd == 'migrate')) for desc in descs]
+    except (ValueError, IOError) as ex:
+        sys.exit("Error: %s" % (str(ex),))
+
+    try:
+        if args.cmd == 'stats':
+            showStats(caches)
+        elif args.cmd == 'purge':
+            purgeExpired(caches)
+        elif args.cmd == 'evict':
+            evictToQuota(caches, args.quota, args.per_map)
+        elif args.cmd == 'vacuum':
+            vacuum(caches, args.pages)
+        elif args.cmd == 'migrate':
+            showLayout(caches)
+    finally:
+        for desc, cache in caches:
+            cache.close()
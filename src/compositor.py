@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+""" composite the map layers in one pass over numpy arrays """
+
+import numpy as np
+from PIL import Image
+
+#the modes without transparency, to skip checking the alpha channel
+OPAQUE_MODES = ("RGB", "L", "CMYK", "YCbCr")
+
+def isOpaque(img):
+    if img.mode in OPAQUE_MODES:
+        return True
+    if img.mode == "P":
+        return "transparency" not in img.info
+    return False
+
+# return the h x w x 4 uint8 array of the image.
+# P (with or without transparency), L, LA and RGB are converted to RGBA.
+def toRGBAArray(img):
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    return np.asarray(img)
+
+# composite the @layers, [(img, alpha), ...] from the bottom to the top, over the @bg color.
+# each img is of @size, in RGBA, P or L mode, or None to skip; alpha is between 0.0~1.0.
+# return the opaque RGBA image.
+def compositeLayers(size, layers, bg=(255, 255, 255)):
+    w, h = size
+    dst = None       #h x w x 3 float32 array, once blended
+    dst_img = None   #the top opaque layer, if nothing blended over it
+
+    for img, alpha in layers:
+        if img is None or alpha <= 0:
+            continue
+        if img.size != (w, h):
+            raise ValueError("the layer size %s is not %s" % (str(img.size), str(size)))
+
+        #the opaque layer covers all below
+        if alpha >= 1.0 and isOpaque(img):
+            dst, dst_img = None, img
+            continue
+
+        src = toRGBAArray(img)
+        src_a = src[..., 3]
+        is_opaque = isOpaque(img) or src_a.min() == 255
+        if alpha >= 1.0 and is_opaque:
+            dst, dst_img = None, img
+            continue
+
+        #only the bounding box of the visible pixels
+        if not is_opaque:
+            rows = np.flatnonzero(src_a.any(axis=1))
+            if not len(rows):
+                continue  #transparent
+            cols = np.flatnonzero(src_a.any(axis=0))
+            box = (slice(rows[0], rows[-1] +1), slice(cols[0], cols[-1] +1))
+        else:
+            box = (slice(None), slice(None))
+
+        if dst is None:
+            if dst_img is not None:
+                dst = toRGBAArray(dst_img)[..., :3].astype(np.float32)
+                dst_img = None
+            else:
+                dst = np.empty((h, w, 3), np.float32)
+                dst[...] = bg
+
+        #over: dst = src * a + dst * (1 - a), in place
+        diff = src[box][..., :3].astype(np.float32)
+        diff -= dst[box]
+        if is_opaque:
+            diff *= alpha
+        else:
+            a = src_a[box].astype(np.float32)
+            a *= alpha / 255.0
+            diff *= a[..., np.newaxis]
+        dst[box] += diff
+
+    if dst_img is not None:
+        return dst_img.convert("RGBA")
+
+    out = np.empty((h, w, 4), np.uint8)
+    out[..., 3] = 255
+    if dst is None:
+        out[..., :3] = bg
+    else:
+        np.add(dst, 0.5, out=dst)
+        out[..., :3] = dst  #truncated, as rounded
+    return Image.fromarray(out, "RGBA")
@@ -174,11 +174,59 @@ __app_conf = __readConf(__APP_CONF)
 __mapcache_dir  = __app_conf.get('settings', 'mapcache_dir', fallback='mapcache')
 __gpsbabel_exe  = __app_conf.get('settings', 'gpsbabel_exe', fallback=__defaultGpsbabelExe())
 __db_schema     = __app_conf.get('settings', 'db_schema', fallback='tms')
+__dl_max_works      = __app_conf.getint('settings', 'dl_max_works', fallback=8)
+__dl_max_host_works = __app_conf.getint('settings', 'dl_max_host_works', fallback=4)
+__dl_map_max_works  = __app_conf.getint('settings', 'dl_map_max_works', fallback=3)
+__dl_prefetch_ring  = __app_conf.getint('settings', 'dl_prefetch_ring', fallback=2)
+__dl_prefetch_levels = __app_conf.getboolean('settings', 'dl_prefetch_levels', fallback=True)
+__dl_retry_limit     = __app_conf.getint('settings', 'dl_retry_limit', fallback=5)
+__dl_retry_delay     = __app_conf.getint('settings', 'dl_retry_delay_sec', fallback=10)
+__dl_retry_max_delay = __app_conf.getint('settings', 'dl_retry_max_delay_sec', fallback=600)
+__dl_breaker_fails     = __app_conf.getint('settings', 'dl_breaker_fails', fallback=5)
+__dl_breaker_delay     = __app_conf.getint('settings', 'dl_breaker_delay_sec', fallback=10)
+__dl_breaker_max_delay = __app_conf.getint('settings', 'dl_breaker_max_delay_sec', fallback=300)
+__dl_host_rate       = __app_conf.getint('settings', 'dl_host_rate', fallback=16)
+__mem_cache_mb      = __app_conf.getint('settings', 'mem_cache_mb', fallback=256)
+__mem_cache_neg_ttl = __app_conf.getint('settings', 'mem_cache_neg_ttl_sec', fallback=120)
+__mem_fake_cache_mb = __app_conf.getint('settings', 'mem_fake_cache_mb', fallback=32)
+__mem_composite_cache_mb = __app_conf.getint('settings', 'mem_composite_cache_mb', fallback=64)
+__db_batch_size     = __app_conf.getint('settings', 'db_batch_size', fallback=64)
+__db_batch_ms       = __app_conf.getint('settings', 'db_batch_ms', fallback=500)
+__db_journal_mode   = __app_conf.get('settings', 'db_journal_mode', fallback='WAL')
+__tile_missing_expire_days = __app_conf.getint('settings', 'tile_missing_expire_days', fallback=30)
+__db_synchronous    = __app_conf.get('settings', 'db_synchronous', fallback='NORMAL')
+__db_cache_size     = __app_conf.getint('settings', 'db_cache_size', fallback=-8192)
+__db_mmap_size      = __app_conf.getint('settings', 'db_mmap_size', fallback=64*1024*1024)
+__db_dedup          = __app_conf.getboolean('settings', 'db_dedup', fallback=False)
 
 #publish conf
 MAPCACHE_DIR  = abspath(__mapcache_dir, __HOME_DIR)
 GPSBABEL_EXE  = abspath(__gpsbabel_exe, __HOME_DIR)
 DB_SCHEMA     = __db_schema            #valid value is 'tms' or 'zyx'
+DL_MAX_WORKS      = max(1, __dl_max_works)       #download works of all maps
+DL_MAX_HOST_WORKS = max(1, __dl_max_host_works)  #download works to a host
+DL_MAP_MAX_WORKS  = max(1, __dl_map_max_works)   #download works of a map, if the map descriptor not specified
+DL_PREFETCH_RING  = max(0, __dl_prefetch_ring)    #tiles around the viewport to prefetch when idle
+DL_PREFETCH_LEVELS = __dl_prefetch_levels         #prefetch the parent/child tiles of the viewport when idle
+DL_RETRY_LIMIT     = max(0, __dl_retry_limit)        #retry times of a failed tile by the backoff, then retried at the max delay
+DL_RETRY_DELAY     = max(1, __dl_retry_delay)        #seconds before the first retry, doubled for each retry
+DL_RETRY_MAX_DELAY = max(DL_RETRY_DELAY, __dl_retry_max_delay)
+DL_BREAKER_FAILS     = max(1, __dl_breaker_fails)    #continuous failures to pause the requests to a host
+DL_BREAKER_DELAY     = max(1, __dl_breaker_delay)    #seconds to pause, doubled if the probe is failed
+DL_BREAKER_MAX_DELAY = max(DL_BREAKER_DELAY, __dl_breaker_max_delay)
+DL_HOST_RATE       = max(0, __dl_host_rate)          #requests per second to a host, 0 is unlimited
+MEM_CACHE_SIZE    = max(1, __mem_cache_mb) * 1024 * 1024  #budget of decoded tiles in memory, in bytes
+MEM_CACHE_NEG_TTL = max(0, __mem_cache_neg_ttl)           #seconds to keep the status of tiles without data
+MEM_FAKE_CACHE_SIZE = max(1, __mem_fake_cache_mb) * 1024 * 1024  #budget of the fake tiles from other levels, in bytes
+MEM_COMPOSITE_CACHE_SIZE = max(1, __mem_composite_cache_mb) * 1024 * 1024  #budget of the tiles composited from the map layers, in bytes
+DB_BATCH_SIZE     = max(1, __db_batch_size)     #flush the pending tiles to db if the count is reached
+DB_BATCH_PERIOD   = timedelta(milliseconds=max(0, __db_batch_ms))  #or the oldest pending tile is too old
+TILE_MISSING_EXPIRE = max(0, __tile_missing_expire_days) * 86400  #seconds to keep the tiles not existing in the server
+DB_JOURNAL_MODE   = __db_journal_mode           #sqlite pragmas of mbtiles files
+DB_SYNCHRONOUS    = __db_synchronous
+DB_CACHE_SIZE     = __db_cache_size             #in pages, or in KiB if negative
+DB_MMAP_SIZE      = __db_mmap_size              #in bytes
+DB_DEDUP          = __db_dedup                  #store the same tile data once, the caches in the old layout are migrated
 TRK_COLORS    = __readTrkColors(__app_conf)
 APP_SYMS      = __readAppSyms(__app_conf)
 
@@ -187,6 +235,30 @@ def writeAppConf():
     __app_conf['settings']['mapcache_dir'] = preferOrigIfEql(MAPCACHE_DIR, __mapcache_dir, __HOME_DIR)
     __app_conf['settings']['gpsbabel_exe'] = preferOrigIfEql(GPSBABEL_EXE, __gpsbabel_exe, __HOME_DIR)
     __app_conf['settings']['db_schema'] = DB_SCHEMA
+    __app_conf['settings']['dl_max_works'] = str(DL_MAX_WORKS)
+    __app_conf['settings']['dl_max_host_works'] = str(DL_MAX_HOST_WORKS)
+    __app_conf['settings']['dl_map_max_works'] = str(DL_MAP_MAX_WORKS)
+    __app_conf['settings']['dl_prefetch_ring'] = str(DL_PREFETCH_RING)
+    __app_conf['settings']['dl_prefetch_levels'] = str(DL_PREFETCH_LEVELS)
+    __app_conf['settings']['dl_retry_limit'] = str(DL_RETRY_LIMIT)
+    __app_conf['settings']['dl_retry_delay_sec'] = str(DL_RETRY_DELAY)
+    __app_conf['settings']['dl_retry_max_delay_sec'] = str(DL_RETRY_MAX_DELAY)
+    __app_conf['settings']['dl_breaker_fails'] = str(DL_BREAKER_FAILS)
+    __app_conf['settings']['dl_breaker_delay_sec'] = str(DL_BREAKER_DELAY)
+    __app_conf['settings']['dl_breaker_max_delay_sec'] = str(DL_BREAKER_MAX_DELAY)
+    __app_conf['settings']['dl_host_rate'] = str(DL_HOST_RATE)
+    __app_conf['settings']['mem_cache_mb'] = str(MEM_CACHE_SIZE // (1024 * 1024))
+    __app_conf['settings']['mem_cache_neg_ttl_sec'] = str(MEM_CACHE_NEG_TTL)
+    __app_conf['settings']['mem_fake_cache_mb'] = str(MEM_FAKE_CACHE_SIZE // (1024 * 1024))
+    __app_conf['settings']['mem_composite_cache_mb'] = str(MEM_COMPOSITE_CACHE_SIZE // (1024 * 1024))
+    __app_conf['settings']['db_batch_size'] = str(DB_BATCH_SIZE)
+    __app_conf['settings']['db_batch_ms'] = str(int(DB_BATCH_PERIOD.total_seconds() * 1000))
+    __app_conf['settings']['tile_missing_expire_days'] = str(TILE_MISSING_EXPIRE // 86400)
+    __app_conf['settings']['db_journal_mode'] = DB_JOURNAL_MODE
+    __app_conf['settings']['db_synchronous'] = DB_SYNCHRONOUS
+    __app_conf['settings']['db_cache_size'] = str(DB_CACHE_SIZE)
+    __app_conf['settings']['db_mmap_size'] = str(DB_MMAP_SIZE)
+    __app_conf['settings']['db_dedup'] = str(DB_DEDUP)
 
     __app_conf['trk_colors'] = OrderedDict()
     for i in range(len(TRK_COLORS)):
@@ -348,8 +348,20 @@ class Track:
     def time(self):
         return self.__trkseg[0].time if len(self.__trkseg) > 0 else datetime.min
 
+    #bounds of the points, None if no points
+    @property
+    def maxlon(self): return self.__getBounds()[0]
+    @property
+    def minlon(self): return self.__getBounds()[1]
+    @property
+    def maxlat(self): return self.__getBounds()[2]
+    @property
+    def minlat(self): return self.__getBounds()[3]
+
     def __init__(self):
         self.__trkseg = []
+        self.__bounds = (None, None, None, None)  #(maxlon, minlon, maxlat, minlat), None if not updated
+        self.__simplified = {}  #level -> the points simplified for the level
         self.name = ''
         self.color = 'DarkMagenta'
 
@@ -361,18 +373,62 @@ class Track:
 
     def __setitem__(self, idx, val):
         self.__trkseg[idx] = val
+        self.__bounds = None
+        self.__simplified = {}
 
     def __delitem__(self, idx):
         del self.__trkseg[idx]
+        self.__bounds = None
+        self.__simplified = {}
 
     def __len__(self):
         return len(self.__trkseg)
 
     def add(self, pt):
         self.__trkseg.append(pt)
+        self.__simplified = {}
+        if self.__bounds is not None:
+            maxlon, minlon, maxlat, minlat = self.__bounds
+            self.__bounds = (GpsDocument.safe_max(maxlon, pt.lon), GpsDocument.safe_min(minlon, pt.lon),
+                             GpsDocument.safe_max(maxlat, pt.lat), GpsDocument.safe_min(minlat, pt.lat))
 
     def remove(self, pt):
         self.__trkseg.remove(pt)
+        self.__bounds = None
+        self.__simplified = {}
+
+    #the bounds are updated as adding points, and re-computed after removing points
+    def __getBounds(self):
+        if self.__bounds is None:
+            if not self.__trkseg:
+                self.__bounds = (None, None, None, None)
+            else:
+                lons = [pt.lon for pt in self.__trkseg]
+                lats = [pt.lat for pt in self.__trkseg]
+                self.__bounds = (max(lons), min(lons), max(lats), min(lats))
+        return self.__bounds
+
+    #the points simplified for the @level, built as needed and kept until the points are edited
+    def getSimplified(self, level):
+        pts = self.__simplified.get(level)
+        if pts is None:
+            pts = self.__simplified[level] = self.simplifyPoints(self.__trkseg, level)
+        return pts
+
+    # drop the points at the same pixel of @level as the previous kept point, which draw nothing more.
+    # the last point is kept to end the line, so the line is drawn the same.
+    @classmethod
+    def simplifyPoints(cls, pts, level):
+        simplified = []
+        last_px = None
+        for pt in pts:
+            px = pt.pixel(level)
+            if px != last_px:
+                simplified.append(pt)
+                last_px = px
+        if simplified and simplified[-1] is not pts[-1]:
+            simplified.append(pts[-1])
+        return simplified
 
     def split(self, split_fn):
         sp_trks = []
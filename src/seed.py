@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+""" seed the tiles of an area to the local cache, resumable """
+
+import os
+import json
+import logging
+import time
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+
+import src.conf as conf
+from src.tile import TileAgent, PolygonTiles
+
+def bboxToPolygon(low_lat, up_lat, left_lon, right_lon):
+    return [(up_lat, left_lon), (up_lat, right_lon), (low_lat, right_lon), (low_lat, left_lon)]
+
+class TileSeeder:
+    """ Download the tiles of the polygon in the levels to the disk cache of the map.
+        The tiles already in the cache are skipped.
+        The progress is saved to @state_path periodically and when stopped, so that an interrupted seeding can be resumed. """
+
+    SAVE_PERIOD = 5   #seconds
+    REPORT_PERIOD = 2 #seconds
+    HOST_DOWN_WAIT = 1  #min seconds to wait for the host, to retry the tiles failed as its circuit is open
+
+    @property
+    def state(self):
+        return dict(self.__state)
+
+    def __init__(self, map_desc, cache_dir, polygon, level_min, level_max, state_path=None, max_works=None, is_restart=False):
+        if level_min > level_max:
+            raise ValueError("level_min is larger than level_max")
+        if level_min < map_desc.level_min or level_max > map_desc.level_max:
+            raise ValueError("the levels are out of the map range %d~%d" % (map_desc.level_min, map_desc.level_max))
+
+        self.__map_desc = map_desc
+        self.__cache_dir = cache_dir
+        self.__state_path = state_path
+        self.__max_works = max_works if max_works else \
+                           (map_desc.max_works if map_desc.max_works else conf.DL_MAP_MAX_WORKS)
+        self.__stop_event = Event()
+
+        job = {
+            'map_id': map_desc.map_id,
+            'polygon': [list(pt) for pt in polygon],
+            'level_min': level_min,
+            'level_max': level_max,
+        }
+        self.__state = None if is_restart else self.__loadState(job)
+        if self.__state is None:
+            self.__state = dict(job, level=level_min, row=None, done=0, cached=0, failed=0, skipped=0, is_finished=False)
+
+    def __loadState(self, job):
+        if not self.__state_path or not os.path.exists(self.__state_path):
+            return None
+        with open(self.__state_path) as f:
+            state = json.load(f)
+        for k, v in job.items():
+            if state.get(k) != v:
+                if state.get('is_finished'):
+                    return None  #a new job
+                raise ValueError("the seeding state '%s' is of another job, restart it to overwrite" % (self.__state_path,))
+        return state
+
+    def __saveState(self):
+        if not self.__state_path:
+            return
+        tmp_path = self.__state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.__state, f)
+        os.replace(tmp_path, self.__state_path)
+
+    def stop(self):
+        self.__stop_event.set()
+
+    #return 'cached', 'done', 'failed', or 'skipped'
+    def __seedTile(self, agent, level, x, y):
+        if self.__stop_event.is_set():
+            return None
+        if not agent.isInCoverage(level, x, y):
+            return 'skipped'
+        if agent.isTileInDisk(level, x, y):
+            return 'cached'
+        img = agent.getTile(level, x, y, 'sync', allow_fake=False)
+        return 'done' if img is not None else 'failed'
+
+    # seed the tiles, and retry the failed ones while the circuit of their host is open,
+    # which fail without requesting, not to lose them as the host is down for a while.
+    def __seedRow(self, agent, executor, level, tiles):
+        seed = lambda t: self.__seedTile(agent, level, t[0], t[1])
+        results = dict(zip(tiles, executor.map(seed, tiles)))
+        while not self.__stop_event.is_set():
+            failed = [t for t, result in results.items() if result == 'failed']
+            open_times = [agent.getHostOpenTime(level, x, y) for x, y in failed]
+            open_times = [t for t in open_times if t is not None]
+            if not open_times:
+                break
+            logging.info("[%s] The host is down, wait to retry %d tiles" % (self.__map_desc.map_id, len(failed)))
+            self.__stop_event.wait(max(self.HOST_DOWN_WAIT, min(open_times)))
+            results.update(zip(failed, executor.map(seed, failed)))
+        return list(results.values())
+
+    # @progress_cb(state, tiles_per_sec) is invoked periodically.
+    # return True if all the tiles are seeded, False if stopped.
+    def run(self, progress_cb=None):
+        state = self.__state
+        if state['is_finished']:
+            return True
+
+        agent = TileAgent(self.__map_desc, self.__cache_dir, auto_start=True)
+        executor = ThreadPoolExecutor(max_workers=self.__max_works)
+        t_begin = time.time()
+        t_saved = t_reported = t_begin
+        n_begin = state['done'] + state['cached'] + state['failed']
+        try:
+            for level in range(state['level'], state['level_max'] + 1):
+                area = PolygonTiles(state['polygon'], level)
+                row_first = area.row_min if state['row'] is None else state['row'] + 1
+                logging.info("[%s] Seed level %d, rows %d~%d, total %d tiles" % \
+                        (state['map_id'], level, row_first, area.row_max, area.countTiles()))
+
+                for row in range(row_first, area.row_max + 1):
+                    tiles = [(x, row) for first, last in area.getRowRanges(row) for x in range(first, last + 1)]
+                    results = self.__seedRow(agent, executor, level, tiles)
+                    if self.__stop_event.is_set():
+                        return False  #the row is incomplete, to seed it again
+
+                    for result in results:
+                        state[result] = state.get(result, 0) + 1
+                    state['level'], state['row'] = level, row
+
+                    now = time.time()
+                    if now - t_saved >= self.SAVE_PERIOD:
+                        self.__saveState()
+                        t_saved = now
+                    if progress_cb and now - t_reported >= self.REPORT_PERIOD:
+                        n = state['done'] + state['cached'] + state['failed'] - n_begin
+                        progress_cb(dict(state), n / (now - t_begin))
+                        t_reported = now
+
+                state['level'], state['row'] = level + 1, None
+
+            state['level'] = state['level_max']
+            state['is_finished'] = True
+            return True
+        finally:
+            self.__stop_event.set()
+            executor.shutdown(wait=True)
+            agent.close()  #flush the pending tiles
+            self.__saveState()
@@ -5,19 +5,26 @@
 
 import os
 import math
+import hashlib
 import tkinter as tk
-from urllib.request import Request, urlopen
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import pathname2url, getproxies, proxy_bypass
+from http.client import HTTPConnection, HTTPSConnection, BadStatusLine
 import shutil
 import sqlite3
 import logging
-import random
 import time
+import heapq
+import bisect
+import itertools
+import base64
+from array import array
 from xml.etree import ElementTree as ET
 from datetime import datetime, timedelta
 from os import listdir
 from os.path import isdir, isfile, exists
 from PIL import Image, ImageTk, ImageDraw, ImageTk
-from threading import Thread, Lock, Condition
+from threading import Thread, Lock, Condition, Event
 from math import tan, sin, cos, radians, degrees
 from collections import OrderedDict
 from io import BytesIO
@@ -31,6 +38,8 @@ to_pixel = coord.TileSystem.getPixcelXYByTileXY
 to_tile = coord.TileSystem.getTileXYByPixcelXY
 
 class MapDescriptor:
+    DEF_MAX_CONNS = 4
+
     #should construct from static methods.
     def __init__(self):
         #NOTEICE: see clone() method to see full fields
@@ -78,8 +87,21 @@ class MapDescriptor:
         #bgcolor = ET.SubElement(root, "backgroundColor")
         #bgcolor.text = "#FFFFFF"
 
-        #tile_update = ET.SubElement(root, "tileUpdate")
-        #tile_update.text = "IfNotMatch"
+        if self.coverage:
+            coverage = ET.SubElement(root, "coverage")
+            coverage.text = self.coverage
+
+        if self.tile_update:
+            tile_update = ET.SubElement(root, "tileUpdate")
+            tile_update.text = self.tile_update
+
+        if self.max_conns != self.DEF_MAX_CONNS:
+            max_conns = ET.SubElement(root, "maxConnections")
+            max_conns.text = str(self.max_conns)
+
+        if self.max_works:
+            max_works = ET.SubElement(root, "maxWorks")
+            max_works.text = str(self.max_works)
 
         if self.expire_sec:
             exp_text = "%.3f" % (self.expire_sec / 86400.0,)
@@ -106,7 +128,12 @@ class MapDescriptor:
         desc.coord_sys = self.coord_sys
         desc.lower_corner = self.lower_corner
         desc.upper_corner = self.upper_corner
+        desc.coverage = self.coverage
+        desc.coverage_path = self.coverage_path
         desc.expire_sec = self.expire_sec
+        desc.tile_update = self.tile_update
+        desc.max_conns = self.max_conns
+        desc.max_works = self.max_works
         desc.alpha = self.alpha
         desc.enabled = self.enabled
         return desc
@@ -157,7 +184,7 @@ class MapDescriptor:
         return 0
 
     @classmethod
-    def __parseXml(cls, xml_root, id):
+    def __parseXml(cls, xml_root, id, dirpath=None):
         if not id:
             raise ValueError("[map desc] map id is empty")
 
@@ -192,9 +219,25 @@ class MapDescriptor:
         lower_corner = cls.__parseLatlon(cls.__getElemText(xml_root, "./lowerCorner", ""), (-180, -85))
         upper_corner = cls.__parseLatlon(cls.__getElemText(xml_root, "./upperCorner", ""), (180, 85))
 
+        #the polygon file of the coverage, relative to the descriptor
+        coverage = cls.__getElemText(xml_root, "./coverage", "")
+        coverage = coverage.strip() if coverage else ""
+        coverage_path = coverage
+        if coverage and dirpath and not os.path.isabs(coverage):
+            coverage_path = os.path.join(dirpath, coverage)
+
         expire_days = cls.__getElemText(xml_root, "./expireDays", "0")
         expire_sec = cls.__parseExpireDays(expire_days, id)
 
+        tile_update = cls.__getElemText(xml_root, "./tileUpdate", "")
+        tile_update = tile_update.strip() if tile_update else ""
+
+        max_conns = int(cls.__getElemText(xml_root, "./maxConnections", str(cls.DEF_MAX_CONNS)))
+        max_conns = cls.__cropValue(max_conns, 1, 16, "[map desc '%s'] max connections should be in 1~16" % (id,))
+
+        max_works = int(cls.__getElemText(xml_root, "./maxWorks", "0"))  #0 to use the app setting
+        max_works = cls.__cropValue(max_works, 0, 16, "[map desc '%s'] max works should be in 0~16" % (id,))
+
         #collection data
         desc = MapDescriptor()
         desc.map_id = id
@@ -207,7 +250,12 @@ class MapDescriptor:
         desc.coord_sys = coord_sys
         desc.lower_corner = lower_corner
         desc.upper_corner = upper_corner
+        desc.coverage = coverage
+        desc.coverage_path = coverage_path
         desc.expire_sec = expire_sec
+        desc.tile_update = tile_update
+        desc.max_conns = max_conns
+        desc.max_works = max_works
         desc.tile_format = tile_type
         return desc
 
@@ -217,7 +265,7 @@ class MapDescriptor:
             xml_root = ET.parse(filepath).getroot()
             if not id:
                 id = os.path.splitext(os.path.basename(filepath))[0]
-            return cls.__parseXml(xml_root, id)
+            return cls.__parseXml(xml_root, id, os.path.dirname(filepath))
         elif xmlstr is not None:
             xml_root = ET.fromstring(xmlstr)
             return cls.__parseXml(xml_root, id)
@@ -230,6 +278,133 @@ class MapDescriptor:
         return []
 
 
+class PolygonTiles:
+    """ The tiles of a polygon at a level, row by row.
+        The x ranges of a row are the projection of the polygon clipped by the row band,
+        which are from the polygon edges in the band and the crossings of the band borders. """
+    TILE_SIZE = 256
+
+    def __init__(self, polygon, level):
+        self.level = level
+        self.__pts = [coord.TileSystem.getPixcelXYByLatLon(lat, lon, level) for lat, lon in polygon]
+
+        max_tile = (1 << level) - 1
+        ys = [py for px, py in self.__pts]
+        self.row_min = max(0, int(min(ys) // self.TILE_SIZE))
+        self.row_max = min(max_tile, int(max(ys) // self.TILE_SIZE))
+        self.__max_tile = max_tile
+        self.__rows = {}  #row -> x ranges, cached for contains()
+
+    @classmethod
+    def __mergeRanges(cls, ranges):
+        merged = []
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    def __edges(self):
+        pts = self.__pts
+        for i in range(len(pts)):
+            yield pts[i-1], pts[i]
+
+    #the x pixel ranges inside the polygon along the horizontal line @py
+    def __crossRanges(self, py):
+        xs = []
+        for (x1, y1), (x2, y2) in self.__edges():
+            if (y1 <= py) != (y2 <= py):
+                xs.append(x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+        xs.sort()
+        return [(xs[i], xs[i+1]) for i in range(0, len(xs) - 1, 2)]
+
+    #the x pixel ranges of the edges clipped by the band [y_top, y_bottom]
+    def __edgeRanges(self, y_top, y_bottom):
+        ranges = []
+        for (x1, y1), (x2, y2) in self.__edges():
+            if max(y1, y2) < y_top or min(y1, y2) > y_bottom:
+                continue
+            if y1 == y2:
+                ranges.append((min(x1, x2), max(x1, x2)))
+                continue
+            t1 = (max(y_top, min(y1, y2)) - y1) / (y2 - y1)
+            t2 = (min(y_bottom, max(y1, y2)) - y1) / (y2 - y1)
+            xa, xb = x1 + t1 * (x2 - x1), x1 + t2 * (x2 - x1)
+            ranges.append((min(xa, xb), max(xa, xb)))
+        return ranges
+
+    # return the tile x ranges [(x_first, x_last), ...] of the row
+    def getRowRanges(self, row):
+        y_top = row * self.TILE_SIZE
+        y_bottom = y_top + self.TILE_SIZE - 1
+        ranges = self.__edgeRanges(y_top, y_bottom) + self.__crossRanges(y_top) + self.__crossRanges(y_bottom)
+
+        tile_ranges = []
+        for x1, x2 in ranges:
+            first = max(0, int(x1 // self.TILE_SIZE))
+            last = min(self.__max_tile, int(x2 // self.TILE_SIZE))
+            if first <= last:
+                tile_ranges.append((first, last))
+        return self.__mergeRanges(tile_ranges)
+
+    def contains(self, x, y):
+        if y < self.row_min or y > self.row_max:
+            return False
+        ranges = self.__rows.get(y)
+        if ranges is None:
+            ranges = self.getRowRanges(y)
+            self.__rows[y] = ranges
+        for first, last in ranges:
+            if first <= x <= last:
+                return True
+        return False
+
+    def countTiles(self):
+        count = 0
+        for row in range(self.row_min, self.row_max + 1):
+            count += sum(last - first + 1 for first, last in self.getRowRanges(row))
+        return count
+
+
+class TileCoverage:
+    """ The tiles in the coverage of a map, which are in the bounds, and in the polygon if any.
+        The tile ranges of the bounds are computed for each level; the rows of the polygon are computed when used. """
+
+    # @lower_corner, @upper_corner: (lon, lat) of the bounds
+    # @polygon: [(lat, lon), ...], or None
+    def __init__(self, level_min, level_max, lower_corner, upper_corner, polygon=None):
+        left, bottom = lower_corner
+        right, top = upper_corner
+        #the corners are cropped to +/-85 when parsed, which means the edge of the world
+        top = coord.TileSystem.MAX_LATITUDE if top >= 85 else top
+        bottom = coord.TileSystem.MIN_LATITUDE if bottom <= -85 else bottom
+        self.__bounds = {}   #level -> (x_min, y_min, x_max, y_max)
+        for level in range(level_min, level_max +1):
+            x_min, y_min = coord.TileSystem.getTileXYByLatLon(top, left, level)
+            x_max, y_max = coord.TileSystem.getTileXYByLatLon(bottom, right, level)
+            self.__bounds[level] = (x_min, y_min, x_max, y_max)
+
+        self.__polygon = polygon
+        self.__areas = {}    #level -> PolygonTiles
+        self.__lock = Lock()
+
+    def contains(self, level, x, y):
+        bounds = self.__bounds.get(level)
+        if bounds is not None:
+            x_min, y_min, x_max, y_max = bounds
+            if x < x_min or x > x_max or y < y_min or y > y_max:
+                return False
+
+        if not self.__polygon:
+            return True
+        with self.__lock:
+            area = self.__areas.get(level)
+            if area is None:
+                area = PolygonTiles(self.__polygon, level)
+                self.__areas[level] = area
+            return area.contains(x, y)
+
 '''
 The agent for getting tiles, using memory cache and db to be efficient.
 '''
@@ -243,9 +418,32 @@ class TileAgent:
     TILE_NOT_IN_MEM  = 0x01
     TILE_NOT_IN_DISK = 0x02
     TILE_EXPIRE      = 0x03
+    TILE_NOT_EXIST   = 0x04   #the server has no the tile
+    TILE_FAKE        = 0x05   #in the fake cache, generated from other levels
     TILE_REQ         = 0x10
     TILE_REQ_FAILED  = 0x20
 
+    #the kinds of tile content, classified when decoded, as img.tile_kind and img.tile_color
+    KIND_MIXED       = 0
+    KIND_TRANSPARENT = 1
+    KIND_UNIFORM     = 2  #filled with img.tile_color in RGBA
+
+    #the decoded tiles are numbered as img.tile_seq, which changes if the tile is decoded again (as downloaded),
+    #to validate what is made from the tiles.
+    __tile_seqs = itertools.count(1)
+
+    VIEW_MARGIN = 2  #tiles around the viewport, whose requests are kept in queue
+    FAKE_MAGNIFY_LEVELS = 3  #upper levels to magnify a fake tile from
+    FAKE_MINIFY_LEVELS = 1   #lower levels to minify a fake tile from
+    REDUCED_MAX_SHIFT = 8    #the reduced tiles are 1/2 ~ 1/256 of the side
+    NOT_EXIST_STATUS = (204, 404, 410)  #the http status meaning the server has no the tile
+    CLOSE_WAIT = 60  #max seconds to wait for the cancelled download jobs when closing
+
+    #download jobs, in the order of priority
+    JOB_REQUEST  = 0   #the tiles requested by the viewer
+    JOB_PREFETCH = 1   #the tiles around the viewport, not requested yet
+    JOB_REFRESH  = 2   #the expired tiles, which are still served until refreshed
+
     #properties from map_desc
     @property
     def map_id(self): return self.__map_desc.map_id
@@ -271,10 +469,35 @@ class TileAgent:
     def expire_sec(self): return self.__map_desc.expire_sec
     @property
     def tile_format(self): return self.__map_desc.tile_format
+    @property
+    def tile_update(self): return self.__map_desc.tile_update
 
     @property
     def state(self): return self.__state
 
+    __shared_mem_cache = None
+    __shared_mem_cache_lock = Lock()
+
+    #tile ids contain the map id, so all agents can share one memory budget
+    @classmethod
+    def __getSharedMemCache(cls):
+        with cls.__shared_mem_cache_lock:
+            if cls.__shared_mem_cache is None:
+                cls.__shared_mem_cache = MemoryCache(cls.TILE_NOT_IN_MEM, is_concurrency=True,
+                        max_bytes=conf.MEM_CACHE_SIZE, neg_ttl=conf.MEM_CACHE_NEG_TTL)
+            return cls.__shared_mem_cache
+
+    __shared_fake_cache = None
+
+    #the fake tiles are kept apart, not to evict the real tiles
+    @classmethod
+    def __getSharedFakeCache(cls):
+        with cls.__shared_mem_cache_lock:
+            if cls.__shared_fake_cache is None:
+                cls.__shared_fake_cache = MemoryCache(cls.TILE_NOT_IN_MEM, is_concurrency=True,
+                        max_bytes=conf.MEM_FAKE_CACHE_SIZE, neg_ttl=conf.MEM_CACHE_NEG_TTL)
+            return cls.__shared_fake_cache
+
     def __init__(self, map_desc, cache_dir, auto_start=False):
         self.__map_desc = map_desc.clone()
 
@@ -284,56 +507,94 @@ class TileAgent:
         self.__cache_dir = cache_dir
         self.__disk_cache = None
 
-        #memory cache
-        self.__mem_cache = MemoryCache(self.TILE_NOT_IN_MEM, is_concurrency=True)
+        #memory cache, shared by all agents
+        self.__mem_cache = self.__getSharedMemCache()
+        self.__fake_cache = self.__getSharedFakeCache()
+        self.__fake_lock = Lock()
+        self.__fake_gen = 0   #increased on invalidating, not to cache the fake tiles generated before
+
+        #keep-alive connections, shared by the download workers
+        self.__conn_pool = ConnectionPool(map_desc.max_conns)
 
         #download helpers
-        self.__MAX_WORKS = 3
+        self.__max_works = map_desc.max_works if map_desc.max_works else conf.DL_MAP_MAX_WORKS
+        self.__executor = DownloadExecutor.instance()
         self.__download_lock = Lock()
         self.__download_cv = Condition(self.__download_lock)
         self.__workers = {}
-        #self.__workers_lock = Lock()
-        #self.__workers_cv = Condition(self.__workers_lock)
-        self.__req_queue = OrderedDict()
-        #self.__req_lock = Lock()
-        #self.__req_cv = Condition(self.__req_lock)
-        self.__download_monitor = Thread(target=self.__runDownloadMonitor)
+        self.__cancels = set()    #ids of the requests in progress to cancel
+        self.__req_queue = {}     #id -> (seq, req)
+        self.__req_heap = []      #[(priority, -seq, id), ...]
+        self.__req_seq = 0
+        self.__refresh_queue = OrderedDict()  #id -> req, the expired tiles to refresh
+        self.__viewport = None    #(level, t_left, t_upper, t_right, t_lower)
+        self.__prefetch = []      #[(level, x, y), ...] around the viewport, the nearer the former
+        self.__prefetch_pos = 0   #the next one to prefetch
+        self.__hosts = {}  #server part -> host
+        self.__failures = {}  #id -> (failed times, last failed time), for the retry backoff
+        self.__failures_pruned = time.time()
+        self.__coverage = self.__genCoverage(map_desc)
 
         if auto_start:
             self.start()
 
+    def __genCoverage(self, map_desc):
+        polygon = None
+        if map_desc.coverage_path:
+            try:
+                polygon = util.readPolygon(map_desc.coverage_path)
+            except Exception as ex:
+                logging.warning("[%s] Error to read the coverage '%s', use the bounds only: %s" % \
+                        (map_desc.map_id, map_desc.coverage_path, str(ex)))
+        return TileCoverage(map_desc.level_min, map_desc.level_max,
+                map_desc.lower_corner, map_desc.upper_corner, polygon)
+
     def start(self):
         #create cache dir for the map
         self.__disk_cache = DBDiskCache(self.__cache_dir, self.__map_desc, conf.DB_SCHEMA)
         self.__disk_cache.start()
-        #start download thread
+        #start to serve download jobs
         self.__state = self.ST_RUN
-        self.__download_monitor.start()
+        self.__executor.register(self)
 
     def close(self):
-        #notify download monitor to exit
+        #stop serving download jobs, and cancel the jobs in progress
         with self.__download_cv:
             self.__state = self.ST_CLOSING
-            self.__download_cv.notify()
-        self.__download_monitor.join()
+            self.__cancels.update(self.__workers)
+        self.__executor.unregister(self)
+
+        #wait for the jobs in progress, which may still write the disk cache.
+        #the cancelled request stops between reading chunks, or by the connection timeout.
+        with self.__download_cv:
+            deadline = time.time() + self.CLOSE_WAIT
+            while self.__workers:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    logging.warning("[%s] %d download jobs are not done when closing" % (self.map_id, len(self.__workers)))
+                    break
+                self.__download_cv.wait(timeout)
 
         #close resources
+        self.__conn_pool.close()
         if self.__disk_cache is not None:
             self.__disk_cache.close()
 
+        logging.debug("[%s] status(closing), download jobs stopped" % (self.map_id,))
+
     def pause(self):
         with self.__download_cv:
             if self.__state == self.ST_RUN:
                 self.__state = self.ST_PAUSE
                 logging.debug("[%s] Change status from run to pause" % (self.map_id,))
-                self.__download_cv.notify()
 
     def resume(self):
         with self.__download_cv:
-            if self.__state == self.ST_PAUSE:
-                self.__state = self.ST_RUN
-                logging.debug("[%s] Change status from pasue to run" % (self.map_id,))
-                self.__download_cv.notify()
+            if self.__state != self.ST_PAUSE:
+                return
+            self.__state = self.ST_RUN
+            logging.debug("[%s] Change status from pasue to run" % (self.map_id,))
+        self.__executor.notify()
 
     def isSupportedLevel(self, level):
         return self.level_min <= level and level <= self.level_max
@@ -348,77 +609,198 @@ class TileAgent:
     def flipY(cls, y, level):
         return (1 << level) - 1 - y
 
+    #pick the server part by the tile position, so that the same tile always goes to the same host,
+    #and the adjacent tiles are spread over the hosts.
+    def getServerPart(self, x, y):
+        return self.server_parts[(x + y) % len(self.server_parts)]
+
     def genTileUrl(self, level, x, y):
+        server_part = self.getServerPart(x, y) if self.server_parts else None
+
         if self.invert_y:
             y = self.flipY(y, level)
 
         url = self.url_template;
 
-        if self.server_parts:
-            url = url.replace("{$serverpart}", random.choice(self.server_parts))
+        if server_part:
+            url = url.replace("{$serverpart}", server_part)
         url = url.replace("{$x}", str(x))
         url = url.replace("{$y}", str(y))
         url = url.replace("{$z}", str(level))
         #logging.critical('url: ' + url)
         return url
 
-    def __downloadTile(self, id, req):
+    def getTileHost(self, level, x, y):
+        server_part = self.getServerPart(x, y) if self.server_parts else None
+        host = self.__hosts.get(server_part)
+        if host is None:
+            key, path = ConnectionPool.parseUrl(self.genTileUrl(level, x, y))
+            host = key[1]
+            self.__hosts[server_part] = host
+        return host
+
+    # @ticket: of the request granted by the host health, to report the result
+    def __downloadTile(self, id, req, ticket):
         level, x, y, status, cb = req  #unpack the req
 
         tile_data = None
+        res_headers = None
+        is_not_modified = False
+        is_not_exist = False
+        is_host_ok = False  #the host works, even if the tile is failed
         try:
             url = self.genTileUrl(level, x, y)
-            req = Request(url, headers={'User-Agent': 'Mozilla/5.0'})
             logging.info("[%s] DL %s" % (self.map_id, url))
-            with urlopen(req, timeout=30) as response:
-                tile_data = response.read()
-            logging.info('[%s] DL %s [OK]' % (self.map_id, url))
+            is_cancelled = lambda: id in self.__cancels
+            headers = self.__genConditionalHeaders(level, x, y) if (status & 0x0F) == self.TILE_EXPIRE else None
+            res_status, res_headers, res_data = self.__conn_pool.request(url, headers=headers, is_cancelled=is_cancelled)
+            is_host_ok = res_status < 500 and res_status != 429  #not server errors, or too many requests
+            if res_status == 304 and headers:
+                is_not_modified = True
+                logging.info('[%s] DL %s [NOT MODIFIED]' % (self.map_id, url))
+            elif res_status in self.NOT_EXIST_STATUS or (res_status == 200 and not res_data):
+                is_not_exist = True
+                logging.info('[%s] DL %s [NOT EXIST][%d]' % (self.map_id, url, res_status))
+            elif res_status != 200:
+                raise IOError("HTTP status %d" % (res_status,))
+            else:
+                tile_data = res_data
+                logging.info('[%s] DL %s [OK]' % (self.map_id, url))
+        except RequestCancelled:
+            logging.info('[%s] DL %s [CANCELLED]' % (self.map_id, url))
+            self.__mem_cache.set(id, status & 0x0F)  #not requested, to be requested again if needed
+            return None
         except Exception as ex:
             logging.warning('[%s] DL %s [FAILED][%s]' % (self.map_id, url, str(ex)))
 
+        self.__executor.reportHost(self.getTileHost(level, x, y), is_host_ok, ticket)
+
         #as failed, and not save to memory/disk
         if self.__state == self.ST_CLOSING:
             return None
 
-        if tile_data is None:
+        if is_not_modified:
+            tile_img = self.__revalidateTile(id, level, x, y)
+            if tile_img is not None:
+                self.__clearFailure(id)
+                return tile_img
+
+        if is_not_exist:
+            self.__mem_cache.set(id, self.TILE_NOT_EXIST)
+            self.__clearFailure(id)
+            try:
+                self.__disk_cache.putMissing(level, x, y, res_status)
+            except Exception as ex:
+                logging.error("[%s] Error to save missing tile: %s" % (self.map_id, str(ex)))
+            return None
+
+        #get tile_img, and save to memory
+        tile_img = None
+        if tile_data is not None:
+            try:
+                tile_img = self.__openTile(tile_data)
+            except Exception as ex:
+                logging.error("[%s] Error to open tile data: %s" % (self.map_id, str(ex)))
+
+        if tile_img is None:
             #save to memory
             status = self.TILE_REQ_FAILED | (status & 0x0F)
             self.__mem_cache.set(id, status)
+            self.__addFailure(id)
             return None
 
-        #get tile_img, and save to memory
-        tile_img = None
+        self.__mem_cache.set(id, self.TILE_VALID, tile_img)
+        self.__clearFailure(id)
+        self.__invalidateFakeTiles(level, x, y)
+        self.__invalidateReducedTiles(level, x, y)
+
+        #save tile_data to disk, with the validators for the conditional requests
         try:
-            tile_img = Image.open(BytesIO(tile_data))
-            self.__mem_cache.set(id, self.TILE_VALID, tile_img)
+            self.__disk_cache.put(level, x, y, tile_data,
+                    res_headers.get("ETag"), res_headers.get("Last-Modified"))
         except Exception as ex:
-            logging.error("[%s] Error to open tile data: %s" % (self.map_id, str(ex)))
-            return None
+            logging.error("[%s] Error to save tile data: %s" % (self.map_id, str(ex)))
+
+        return tile_img
+
+    def __addFailure(self, id):
+        now = time.time()
+        with self.__download_cv:
+            times, ts = self.__failures.get(id, (0, 0))
+            self.__failures[id] = (times + 1, now)
 
-        #save tile_data to disk
+            #drop the failures which are due anyway, not to grow with the tiles ever failed
+            if now - self.__failures_pruned >= conf.DL_RETRY_MAX_DELAY:
+                self.__failures = {k: v for k, v in self.__failures.items() if now - v[1] < conf.DL_RETRY_MAX_DELAY}
+                self.__failures_pruned = now
+
+    def __clearFailure(self, id):
+        with self.__download_cv:
+            self.__failures.pop(id, None)
+
+    #if the failed tile can be requested again, by the exponential backoff,
+    #which is kept at the max delay after the retry limit, not to give up the tile when the host recovers.
+    def __isRetryDue(self, id):
+        with self.__download_cv:
+            item = self.__failures.get(id)
+        if item is None:
+            return True
+        times, ts = item
+        if times > conf.DL_RETRY_LIMIT:
+            delay = conf.DL_RETRY_MAX_DELAY
+        else:
+            delay = min(conf.DL_RETRY_DELAY * (2 ** (times - 1)), conf.DL_RETRY_MAX_DELAY)
+        return (time.time() - ts) >= delay
+
+    def isConditionalUpdate(self):
+        return self.tile_update.lower() != "none"
+
+    #the headers to revalidate the expired tile, or None if not supported
+    def __genConditionalHeaders(self, level, x, y):
+        if not self.isConditionalUpdate():
+            return None
         try:
-            self.__disk_cache.put(level, x, y, tile_data)
+            etag, last_modified = self.__disk_cache.getValidators(level, x, y)
         except Exception as ex:
-            logging.error("[%s] Error to save tile data: %s" % (self.map_id, str(ex)))
+            logging.warning("[%s] Error to read tile validators: %s" % (self.map_id, str(ex)))
+            return None
 
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers if headers else None
+
+    #the expired tile is not modified, renew it
+    def __revalidateTile(self, id, level, x, y):
+        tile_img, ts = self.__getTileFromDisk(level, x, y)
+        if tile_img is None:
+            return None
+
+        self.__mem_cache.set(id, self.TILE_VALID, tile_img)
+        try:
+            self.__disk_cache.touch(level, x, y)
+        except Exception as ex:
+            logging.error("[%s] Error to renew tile timestamp: %s" % (self.map_id, str(ex)))
         return tile_img
 
-    #The therad to download
-    def __runDownloadJob(self, id, req):
+    #The download job, run by the worker of DownloadExecutor
+    def __runDownloadJob(self, id, req, ticket):
 
         #do download
-        tile_img = self.__downloadTile(id, req)
+        tile_img = self.__downloadTile(id, req, ticket)
 
         #the download is done
-        #(do this before thread exit, to ensure monitor is notified)
         with self.__download_cv:
-            self.__workers.pop(id, None)
-            self.__download_cv.notify()
+            req = self.__workers.pop(id, req)  #the req may be replaced to add the cb
+            self.__cancels.discard(id)
             #premature done
             if self.__state == self.ST_CLOSING:
+                self.__download_cv.notify_all()  #for close() waiting the jobs
                 return
 
-        #invoke cb. cb may be blocking, so do this AFTER removing the thread from __workers
+        #invoke cb. cb may be blocking, so do this AFTER removing the job from __workers
         if tile_img is not None:
             level, x, y, status, cb = req  #unpack the req
             if cb is not None:
@@ -428,45 +810,228 @@ class TileAgent:
                 except Exception as ex:
                      logging.warning("[%s] Invoke cb of download tile error: %s" % (self.map_id, str(ex)))
 
-    #The thread to handle all download requests
-    def __runDownloadMonitor(self):
-        def no_worker():
-            return len(self.__workers) == 0
-
-        #http_handler = urllib.request.HTTPHandler()
-        #opener = urllib.request.build_opener(http_handler)
-        #urllib.request.install_opener(opener)
+    #the smaller the more urgent:
+    #the tiles of the viewing level first, then the tiles near the viewport center.
+    def __getPriority(self, level, x, y):
+        if self.__viewport is None:
+            return (0, 0)
+        v_level, t_left, t_upper, t_right, t_lower = self.__viewport
+        #distance to the center, in half tiles
+        dx = 2*x - (t_left + t_right)
+        dy = 2*y - (t_upper + t_lower)
+        return (abs(level - v_level), dx*dx + dy*dy)
+
+    def __isInViewport(self, level, x, y):
+        if self.__viewport is None:
+            return True
+        v_level, t_left, t_upper, t_right, t_lower = self.__viewport
+        m = self.VIEW_MARGIN
+        return level == v_level and \
+               (t_left - m) <= x <= (t_right + m) and \
+               (t_upper - m) <= y <= (t_lower + m)
+
+    def __pushRequest(self, id, req):
+        level, x, y, status, cb = req  #unpack the req
+        self.__req_seq += 1
+        self.__req_queue[id] = (self.__req_seq, req)
+        heapq.heappush(self.__req_heap, (self.__getPriority(level, x, y), -self.__req_seq, id))  #LIFO if the same priority
+
+    # Set the viewing tiles (t_left, t_upper, t_right, t_lower) at @level.
+    # The queued requests out of the viewport (plus a margin) are dropped, others are re-prioritized.
+    # The requests in progress for other levels are cancelled.
+    def setViewport(self, level, tile_bounds):
+        dropped = []
+        with self.__download_cv:
+            viewport = (level,) + tuple(tile_bounds)
+            if viewport == self.__viewport:
+                return
+            self.__viewport = viewport
+
+            #drop or re-prioritize the queued requests
+            heap = []
+            for id, (seq, req) in list(self.__req_queue.items()):
+                level_, x, y, status, cb = req  #unpack the req
+                if self.__isInViewport(level_, x, y):
+                    heap.append((self.__getPriority(level_, x, y), -seq, id))
+                else:
+                    del self.__req_queue[id]
+                    dropped.append((id, status))
+            heapq.heapify(heap)
+            self.__req_heap = heap
+
+            #drop the refresh requests
+            for id, req in list(self.__refresh_queue.items()):
+                level_, x, y, status, cb = req  #unpack the req
+                if not self.__isInViewport(level_, x, y):
+                    del self.__refresh_queue[id]
+                    dropped.append((id, status))
+
+            #the tiles to prefetch
+            self.__prefetch = self.__genPrefetchTiles(level, tile_bounds)
+            self.__prefetch_pos = 0
+            prefetch_ids = set(self.genTileId(*tile) for tile in self.__prefetch)
+
+            #cancel the requests in progress
+            for id, req in self.__workers.items():
+                if req[0] != level and id not in prefetch_ids:
+                    self.__cancels.add(id)
+
+        #reset the status, then the tiles can be requested again
+        for id, status in dropped:
+            self.__mem_cache.set(id, status & 0x0F)
+
+        if dropped:
+            logging.debug("[%s] drop %d requests out of the viewport" % (self.map_id, len(dropped)))
+
+        if self.__prefetch:
+            self.__executor.notify(self.__max_works)
+
+    # The tiles around the viewport at @level, with the parent tiles at level-1
+    # and the child tiles at level+1, ordered by the nearness to the viewport.
+    def __genPrefetchTiles(self, level, tile_bounds):
+        t_left, t_upper, t_right, t_lower = tile_bounds
+        tiles = []
+
+        def addTiles(level_, left, upper, right, lower, is_ring=False):
+            if not self.isSupportedLevel(level_):
+                return
+            max_t = (1 << level_) - 1
+            left, upper = max(0, left), max(0, upper)
+            right, lower = min(max_t, right), min(max_t, lower)
+            cx, cy = left + right, upper + lower
+            level_tiles = []
+            for x in range(left, right +1):
+                for y in range(upper, lower +1):
+                    if is_ring and t_left <= x <= t_right and t_upper <= y <= t_lower:
+                        continue  #the viewing tiles are requested by the viewer
+                    if not self.__coverage.contains(level_, x, y):
+                        continue
+                    dx, dy = 2*x - cx, 2*y - cy
+                    level_tiles.append((dx*dx + dy*dy, (level_, x, y)))
+            level_tiles.sort()
+            tiles.extend(tile for d, tile in level_tiles)
+
+        if conf.DL_PREFETCH_LEVELS:
+            addTiles(level -1, t_left >> 1, t_upper >> 1, t_right >> 1, t_lower >> 1)
+        r = conf.DL_PREFETCH_RING
+        if r:
+            addTiles(level, t_left - r, t_upper - r, t_right + r, t_lower + r, is_ring=True)
+        if conf.DL_PREFETCH_LEVELS:
+            addTiles(level +1, t_left << 1, t_upper << 1, (t_right << 1) +1, (t_lower << 1) +1)
+        return tiles
+
+    # Called by DownloadExecutor to take a download job.
+    # @is_host_free tells if the host is able to accept one more job.
+    # @job_type is JOB_REQUEST, JOB_PREFETCH or JOB_REFRESH.
+    # return (host, job) or None if no job is available.
+    def popDownloadJob(self, is_host_free, job_type=JOB_REQUEST):
+        with self.__download_cv:
+            if self.__state != self.ST_RUN:
+                return None
+            if len(self.__workers) >= self.__max_works:
+                return None
+            if job_type == self.JOB_PREFETCH:
+                return self.__popPrefetchJob(is_host_free)
+            if job_type == self.JOB_REFRESH:
+                return self.__popRefreshJob(is_host_free)
+
+            job = None
+            busy_entries = []
+            while self.__req_heap:
+                entry = heapq.heappop(self.__req_heap)
+                priority, neg_seq, id = entry
+                item = self.__req_queue.get(id)
+                if item is None or item[0] != -neg_seq:  #obsolete entry
+                    continue
 
-        while True:
-            #wait for requests
-            with self.__download_cv:
-                self.__download_cv.wait()
+                req = item[1]
+                level, x, y, status, cb = req  #unpack the req
+                host = self.getTileHost(level, x, y)
+                if not is_host_free(host):
+                    busy_entries.append(entry)
+                    continue
 
-                if self.__state == self.ST_CLOSING:
-                    logging.debug("[%s] status(closing), download monitor closing" % (self.map_id,))
+                del self.__req_queue[id]
+                if id in self.__workers:
+                    logging.warning("[%s] Opps! the req is DUP and in progress." % (self.map_id,)) #should not happen
                     break
-                elif self.__state == self.ST_PAUSE:
-                    logging.debug("[%s] status(pause), continue to wait" % (self.map_id,))
-                    continue
 
-                if len(self.__req_queue) > 0 and len(self.__workers) < self.__MAX_WORKS:
-                    #the req
-                    id, req = self.__req_queue.popitem() #LIFO
-                    if id in self.__workers:
-                        logging.warning("[%s] Opps! the req is DUP and in progress." % (self.map_id,)) #should not happen
-                    else:
-                        #create the job and run the worker
-                        job = lambda: self.__runDownloadJob(id, req)
-                        worker = Thread(name=id, target=job)
-                        self.__workers[id] = worker
-                        worker.start()
-
-        #todo: interrupt urllib.request.openurl to stop download workers.
-        #http_handler.close()
+                self.__workers[id] = req
+                job = (host, lambda ticket: self.__runDownloadJob(id, req, ticket))
+                break
+
+            for entry in busy_entries:
+                heapq.heappush(self.__req_heap, entry)
+
+            return job
+
+    #NOTICE: should hold __download_cv
+    def __popPrefetchJob(self, is_host_free):
+        if self.__req_queue:
+            return None  #yield to the requested
+
+        while self.__prefetch_pos < len(self.__prefetch):
+            level, x, y = self.__prefetch[self.__prefetch_pos]
+            id = self.genTileId(level, x, y)
+            status = self.__mem_cache.get(id)[1]
+            if id in self.__workers or \
+               status not in (self.TILE_NOT_IN_MEM, self.TILE_NOT_IN_DISK):
+                self.__prefetch_pos += 1
+                continue
+
+            host = self.getTileHost(level, x, y)
+            if not is_host_free(host):
+                return None
+            self.__prefetch_pos += 1
+
+            req = (level, x, y, status, None)
+            self.__workers[id] = req
+            return (host, lambda ticket: self.__runPrefetchJob(id, req, ticket))
+
+        return None
+
+    #NOTICE: should hold __download_cv
+    def __popRefreshJob(self, is_host_free):
+        if self.__req_queue:
+            return None  #yield to the requested
+
+        for id, req in reversed(self.__refresh_queue.items()):  #the latest viewed first
+            level, x, y, status, cb = req  #unpack the req
+            host = self.getTileHost(level, x, y)
+            if not is_host_free(host):
+                continue
+            del self.__refresh_queue[id]
+            self.__workers[id] = req
+            return (host, lambda ticket: self.__runDownloadJob(id, req, ticket))
+
+        return None
+
+    #The prefetch job, run by the worker of DownloadExecutor
+    def __runPrefetchJob(self, id, req, ticket):
+        level, x, y, status, cb = req  #unpack the req
+
+        #load from disk if any
+        try:
+            self.__getTile(level, x, y)
+        except Exception as ex:
+            logging.warning("[%s] prefetch tile(%d,%d,%d) error: %s" % (self.map_id, level, x, y, str(ex)))
+
         with self.__download_cv:
-            #self.__download_cv.wait_for(no_worker)
-            self.__state = self.ST_IDLE
-            logging.debug("[%s] status(idle), download monitor closed" % (self.map_id,))
+            cur_req = self.__workers.get(id)
+            if cur_req is not req:
+                dl_req = cur_req   #requested during the prefetch
+            elif self.__mem_cache.get(id)[1] == self.TILE_NOT_IN_DISK and self.__state == self.ST_RUN:
+                dl_req = (level, x, y, self.TILE_REQ | self.TILE_NOT_IN_DISK, None)
+                self.__workers[id] = dl_req
+                self.__mem_cache.set(id, dl_req[3])
+            else:
+                dl_req = None
+                self.__workers.pop(id, None)
+                self.__cancels.discard(id)
+                self.__download_cv.notify_all()  #for close() waiting the jobs
+
+        if dl_req is not None:
+            self.__runDownloadJob(id, dl_req, ticket)
 
     def __requestTile(self, id, req):
         #check and add to req queue
@@ -474,26 +1039,95 @@ class TileAgent:
             if id in self.__req_queue:
                 return
             if id in self.__workers:
+                self.__cancels.discard(id)  #wanted again
+                if self.__workers[id][4] is None:
+                    self.__workers[id] = req   #to invoke the cb when done
                 return
             #add the req
-            self.__req_queue[id] = req
-            self.__download_cv.notify()
+            self.__pushRequest(id, req)
+
+        #notify out of the lock, the executor locks itself before polling agents
+        self.__executor.notify()
+
+    def __requestRefresh(self, id, req):
+        with self.__download_cv:
+            if id in self.__refresh_queue or id in self.__req_queue or id in self.__workers:
+                return
+            self.__refresh_queue[id] = req
+        self.__executor.notify()
+
+    #set the cb of the request in progress if it has none
+    def __attachCallback(self, id, cb):
+        with self.__download_cv:
+            req = self.__workers.get(id)
+            if req is not None and req[4] is None:
+                self.__workers[id] = req[:4] + (cb,)
 
     def __getTileFromDisk(self, level, x, y):
         try:
             data, ts = self.__disk_cache.get(level, x, y)
             if data is not None:
-                img = Image.open(BytesIO(data))
+                img = self.__openTile(data)
                 return img, ts
         except Exception as ex:
             logging.warning("[%s] Error to read tile data: %s" % (self.map_id, str(ex)))
         return None, None
 
+    #read the tiles which are not in memory from disk in one query, and keep them in memory.
+    def __loadTilesFromDisk(self, level, x_range, y_range):
+        ids = {}
+        for x in x_range:
+            for y in y_range:
+                if not self.__coverage.contains(level, x, y):
+                    continue
+                id = self.genTileId(level, x, y)
+                if self.__mem_cache.get(id)[1] != self.TILE_NOT_IN_MEM:
+                    continue
+                if self.__disk_cache.contains(level, x, y) is False:
+                    #known missing, skip the disk
+                    is_not_exist = self.__disk_cache.isMissing(level, x, y)
+                    self.__mem_cache.set(id, self.TILE_NOT_EXIST if is_not_exist else self.TILE_NOT_IN_DISK)
+                else:
+                    ids[(x, y)] = id
+        if not ids:
+            return
+
+        #query the bounding range of the tiles not in memory
+        xs = [x for x, y in ids.keys()]
+        ys = [y for x, y in ids.keys()]
+        try:
+            tiles = self.__disk_cache.getTiles(level, range(min(xs), max(xs)+1), range(min(ys), max(ys)+1))
+        except Exception as ex:
+            logging.warning("[%s] Error to read tiles data: %s" % (self.map_id, str(ex)))
+            return
+
+        for (x, y), id in ids.items():
+            data, ts = tiles.get((x, y), (None, None))
+            if data is None:
+                is_not_exist = self.__disk_cache.isMissing(level, x, y)
+                self.__mem_cache.set(id, self.TILE_NOT_EXIST if is_not_exist else self.TILE_NOT_IN_DISK)
+                continue
+
+            try:
+                img = self.__openTile(data)
+            except Exception as ex:
+                logging.warning("[%s] Error to read tile data: %s" % (self.map_id, str(ex)))
+                continue
+
+            if ts and self.expire_sec and (time.time() - ts) > self.expire_sec:
+                self.__mem_cache.set(id, self.TILE_EXPIRE, img)  #still served until refreshed
+            else:
+                self.__mem_cache.set(id, self.TILE_VALID, img)
+
     def __getTile(self, level, x, y, req_type=None, cb=None):
         #check level
         if level > self.level_max or level < self.level_min:
             raise ValueError("level is out of range")
 
+        #out of the coverage, no need to cache or download
+        if not self.__coverage.contains(level, x, y):
+            return self.__getBlankTile()
+
         id = self.genTileId(level, x, y)
         img, status, ts = self.__mem_cache.get(id)      #READ FROM memory
         status_bak = status
@@ -501,20 +1135,32 @@ class TileAgent:
         if status == self.TILE_VALID:
             return img
 
+        if status == self.TILE_NOT_EXIST:
+            return None
+
         if (status & 0xF0) == self.TILE_REQ:
+            if req_type == "async" and cb is not None:
+                self.__attachCallback(id, cb)  #may be in prefetching
             return img    # None or Expire
 
         if (status & 0xF0) == self.TILE_REQ_FAILED:
-            if (time.time() - ts) < 60: #todo: user to specify retry period
-                return None
+            if req_type != "sync" and not self.__isRetryDue(id):  #the sync request is retried at once
+                return img    # None or Expire
             status &= 0x0F    #remove req_failed status
 
         if status == self.TILE_NOT_IN_MEM:
-            img, ts = self.__getTileFromDisk(level, x, y)   #READ FROM disk
+            if self.__disk_cache.contains(level, x, y) is False:
+                img, ts = None, None    #known missing, skip the disk
+            else:
+                img, ts = self.__getTileFromDisk(level, x, y)   #READ FROM disk
             if img is None:
+                if self.__disk_cache.isMissing(level, x, y):
+                    self.__mem_cache.set(id, self.TILE_NOT_EXIST)
+                    return None
                 status = self.TILE_NOT_IN_DISK
             elif ts and self.expire_sec and (time.time() - ts) > self.expire_sec:
                 status = self.TILE_EXPIRE
+                self.__mem_cache.set(id, status, img)  #still served until refreshed
             else:
                 self.__mem_cache.set(id, self.TILE_VALID, img)
                 return img
@@ -523,7 +1169,8 @@ class TileAgent:
         if status == self.TILE_NOT_IN_DISK:
             pass
         elif status == self.TILE_EXPIRE:
-            logging.warning("[%s] Tile(%d,%d,%d) is expired" % (self.map_id, level, x, y))
+            if status != status_bak:
+                logging.warning("[%s] Tile(%d,%d,%d) is expired" % (self.map_id, level, x, y))
         else:
             logging.critical("[%s] Error: unexpected tile status: %d" % (self.map_id, status))
             return None
@@ -533,14 +1180,31 @@ class TileAgent:
             if status != status_bak:
                 self.__mem_cache.set(id, status)
             return img
+        elif req_type != "sync" and not self.__isRetryDue(id):
+            #the status may be reset from memory, keep failed
+            self.__mem_cache.set(id, self.TILE_REQ_FAILED | status)
+            return img
         else:
             status |= self.TILE_REQ
             self.__mem_cache.set(id, status)
             if req_type == "async":
-                self.__requestTile(id, (level, x, y, status, cb))
+                if status == (self.TILE_REQ | self.TILE_EXPIRE):
+                    self.__requestRefresh(id, (level, x, y, status, cb))  #serve the expired, and refresh in background
+                else:
+                    self.__requestTile(id, (level, x, y, status, cb))
                 return img
             else:      # sync
-                return self.__downloadTile(id, (level, x, y, status, None))
+                tile_img = None
+                host = self.getTileHost(level, x, y)
+                ticket = self.__executor.acquireHost(host)
+                if ticket is not None:
+                    try:
+                        tile_img = self.__downloadTile(id, (level, x, y, status, None), ticket)
+                    finally:
+                        self.__executor.releaseHost(host, ticket)  #the probe, if cancelled
+                else:
+                    self.__mem_cache.set(id, self.TILE_REQ_FAILED | (status & 0x0F))  #the host is down
+                return tile_img if tile_img is not None else img  #the expired if failed
 
     def __genMagnifyFakeTile(self, level, x, y, diff=1):
         side = to_pixel(1,1)[0]
@@ -562,38 +1226,206 @@ class TileAgent:
 
         for i in range(1, diff+1):
             scale = 2**i
-            img = Image.new("RGBA", (side*scale, side*scale), bg)
+            step = side >> i
+            img = Image.new("RGBA", (side, side), bg)
             has_tile = False
-            #paste tiles
+            #paste the tiles decoded in the reduced size
+            self.__loadReducedTilesFromDisk(level+i, range(x*scale, (x+1)*scale), range(y*scale, (y+1)*scale), i)
             for p in range(scale):
                 for q in range(scale):
-                    t = self.__getTile(level+i, x*scale+p, y*scale+q)
+                    t = self.__getReducedTile(level+i, x*scale+p, y*scale+q, i)
                     if t:
-                        img.paste(t, (p*side, q*side))
+                        img.paste(t, (p*step, q*step))
                         has_tile = True
-            #minify
             if has_tile:
-                img = img.resize((side,side))
                 return img
         return None
 
+    def __genReducedTileId(self, level, x, y, shift):
+        return "%s/%d" % (self.genTileId(level, x, y), shift)
+
+    #decode the tile data in 1/2**@shift of the side.
+    #JPEG is decoded in the reduced scale by the draft mode, up to 1/8, and resized for the rest.
+    @classmethod
+    def __openReducedTile(cls, data, shift):
+        side = to_pixel(1,1)[0] >> shift
+        img = Image.open(BytesIO(data))
+        if img.format == "JPEG":
+            img.draft(img.mode, (side, side))
+        if img.size != (side, side):
+            img = img.resize((side, side), Image.BILINEAR)
+        cls.classifyTile(img)
+        return img
+
+    #read the reduced tiles which are not in memory from disk in one query, and keep them in memory.
+    def __loadReducedTilesFromDisk(self, level, x_range, y_range, shift):
+        ids = {}
+        for x in x_range:
+            for y in y_range:
+                if not self.__coverage.contains(level, x, y):
+                    continue
+                rid = self.__genReducedTileId(level, x, y, shift)
+                if self.__mem_cache.get(rid)[1] != self.TILE_NOT_IN_MEM:
+                    continue
+                status = self.__mem_cache.get(self.genTileId(level, x, y))[1] & 0x0F
+                if status in (self.TILE_NOT_IN_DISK, self.TILE_NOT_EXIST) or \
+                        self.__disk_cache.contains(level, x, y) is False:
+                    self.__mem_cache.set(rid, self.TILE_NOT_IN_DISK)
+                else:
+                    ids[(x, y)] = rid
+        if not ids:
+            return
+
+        xs = [x for x, y in ids.keys()]
+        ys = [y for x, y in ids.keys()]
+        try:
+            tiles = self.__disk_cache.getTiles(level, range(min(xs), max(xs)+1), range(min(ys), max(ys)+1))
+        except Exception as ex:
+            logging.warning("[%s] Error to read tiles data: %s" % (self.map_id, str(ex)))
+            return
+
+        for (x, y), rid in ids.items():
+            data, ts = tiles.get((x, y), (None, None))
+            if data is None:
+                self.__mem_cache.set(rid, self.TILE_NOT_IN_DISK)
+                continue
+
+            try:
+                img = self.__openReducedTile(data, shift)
+            except Exception as ex:
+                logging.warning("[%s] Error to read tile data: %s" % (self.map_id, str(ex)))
+                continue
+
+            if ts and self.expire_sec and (time.time() - ts) > self.expire_sec:
+                self.__mem_cache.set(rid, self.TILE_EXPIRE, img)
+            else:
+                self.__mem_cache.set(rid, self.TILE_VALID, img)
+
+    #the reduced tile from memory or disk, or resized from the full tile
+    def __getReducedTile(self, level, x, y, shift, req_type=None, cb=None):
+        side = to_pixel(1,1)[0] >> shift
+        if not self.__coverage.contains(level, x, y):
+            blank = self.__getBlankTile()
+            img = blank.crop((0, 0, side, side))
+            self.classifyTile(img)
+            img.tile_seq = blank.tile_seq
+            return img
+
+        rid = self.__genReducedTileId(level, x, y, shift)
+        img, status, ts = self.__mem_cache.get(rid)
+        if status == self.TILE_NOT_IN_MEM:
+            self.__loadReducedTilesFromDisk(level, range(x, x+1), range(y, y+1), shift)
+            img, status, ts = self.__mem_cache.get(rid)
+
+        if status == self.TILE_VALID:
+            return img
+        if status == self.TILE_EXPIRE:
+            if req_type:
+                self.__getTile(level, x, y, req_type, cb)  #to refresh
+            return img
+
+        #not in disk, the full tile may be requested
+        tile = self.__getTile(level, x, y, req_type, cb)
+        if tile is None:
+            return None
+        img = tile.resize((side, side), Image.BILINEAR)
+        self.classifyTile(img)
+        img.tile_seq = tile.tile_seq
+        return img
+
+    def __invalidateReducedTiles(self, level, x, y):
+        for shift in range(1, self.REDUCED_MAX_SHIFT +1):
+            self.__mem_cache.remove(self.__genReducedTileId(level, x, y, shift))
+
+    __blank_tile = None
+
+    #the transparent tile for the area out of the coverage, shared by all agents
+    @classmethod
+    def __getBlankTile(cls):
+        if cls.__blank_tile is None:
+            cls.__blank_tile = Image.new("RGBA", (256, 256), (0, 0, 0, 0))
+            cls.classifyTile(cls.__blank_tile)
+        return cls.__blank_tile
+
+    #decode the tile data, and classify the content
+    @classmethod
+    def __openTile(cls, data):
+        img = Image.open(BytesIO(data))
+        cls.classifyTile(img)
+        return img
+
+    #set img.tile_kind, img.tile_color if uniform, and a new img.tile_seq.
+    #the image is loaded, so it is decoded once here rather than when pasted.
+    @classmethod
+    def classifyTile(cls, img):
+        img.tile_seq = next(cls.__tile_seqs)
+        extrema = img.getextrema()
+        if len(img.getbands()) == 1:
+            extrema = (extrema,)
+
+        img.tile_kind = cls.KIND_MIXED
+        img.tile_color = None
+        if img.mode in ("RGBA", "LA") and extrema[-1][1] == 0:
+            img.tile_kind = cls.KIND_TRANSPARENT
+        elif all(lo == hi for lo, hi in extrema):
+            color = img.crop((0, 0, 1, 1)).convert("RGBA").getpixel((0, 0))
+            if color[3] == 0:
+                img.tile_kind = cls.KIND_TRANSPARENT
+            else:
+                img.tile_kind = cls.KIND_UNIFORM
+                img.tile_color = color
+        return img.tile_kind
+
     #gen fake from lower/higher level
     #return None if not avaliable
     def __genFakeTile(self, level, x, y):
         #gen from lower level
-        level_diff = min(level - self.level_min, 3)
+        level_diff = min(level - self.level_min, self.FAKE_MAGNIFY_LEVELS)
         img = self.__genMagnifyFakeTile(level, x, y, level_diff)
         if img:
             return img
 
         #gen from upper level
-        level_diff = min(self.level_max - level, 1)
+        level_diff = min(self.level_max - level, self.FAKE_MINIFY_LEVELS)
         img = self.__genMinifyFakeTile(level, x, y, level_diff)
         if img:
             return img
 
         return None
 
+    #get the fake tile from the fake cache, or generate and cache it (None is cached, too)
+    def __getFakeTile(self, level, x, y):
+        id = self.genTileId(level, x, y)
+        img, status, ts = self.__fake_cache.get(id)
+        if status == self.TILE_FAKE:
+            return img
+
+        gen = self.__fake_gen
+        img = self.__genFakeTile(level, x, y)
+        with self.__fake_lock:
+            if gen == self.__fake_gen:  #not invalidated during generating
+                self.__fake_cache.set(id, self.TILE_FAKE, img)
+        return img
+
+    #remove the fake tiles of the tile, and the ones generated from the tile
+    def __invalidateFakeTiles(self, level, x, y):
+        with self.__fake_lock:
+            self.__fake_gen += 1
+
+        self.__fake_cache.remove(self.genTileId(level, x, y))
+        #the upper tiles minified from the tile
+        for i in range(1, self.FAKE_MINIFY_LEVELS +1):
+            if level - i < self.level_min:
+                break
+            self.__fake_cache.remove(self.genTileId(level - i, x >> i, y >> i))
+        #the lower tiles magnified from the tile
+        for i in range(1, self.FAKE_MAGNIFY_LEVELS +1):
+            if level + i > self.level_max:
+                break
+            for cx in range(x << i, (x+1) << i):
+                for cy in range(y << i, (y+1) << i):
+                    self.__fake_cache.remove(self.genTileId(level + i, cx, cy))
+
     # @cb is only for req_type == "async" to nitify the tile is done,
     # which call cb(tile_info), tile_info = (map_id, level, x, y)
     def getTile(self, level, x, y, req_type, cb=None, allow_fake=True):
@@ -603,58 +1435,695 @@ class TileAgent:
             return img
 
         if allow_fake:
-            img = self.__genFakeTile(level, x, y)
+            img = self.__getFakeTile(level, x, y)
             if img is not None:
                 img.is_fake = True
                 return img
 
         return None
 
+    # get the tiles of the rectangle (@x_range, @y_range) at @level.
+    # return dict of (x, y) -> tile (None if not available)
+    def getTiles(self, level, x_range, y_range, req_type, cb=None, allow_fake=True):
+        self.__loadTilesFromDisk(level, x_range, y_range)
+
+        tiles = {}
+        for x in x_range:
+            for y in y_range:
+                tiles[(x, y)] = self.getTile(level, x, y, req_type, cb, allow_fake)
+        return tiles
+
+    # get the tile in 1/2**@shift of the side, to view the map in a level lower than the tile,
+    # which is cached apart from the full tile.
+    def getReducedTile(self, level, x, y, shift, req_type, cb=None, allow_fake=True):
+        if shift == 0:
+            return self.getTile(level, x, y, req_type, cb, allow_fake)
+        if shift < 0 or shift > self.REDUCED_MAX_SHIFT:
+            raise ValueError("shift is out of range")
+
+        img = self.__getReducedTile(level, x, y, shift, req_type, cb)
+        if img is not None:
+            img.is_fake = False
+            return img
+
+        if allow_fake:
+            img = self.__getFakeTile(level, x, y)
+            if img is not None:
+                side = to_pixel(1,1)[0] >> shift
+                img = img.resize((side, side), Image.BILINEAR)
+                img.is_fake = True
+                return img
+
+        return None
+
+    # get the reduced tiles of the rectangle (@x_range, @y_range) at @level.
+    # return dict of (x, y) -> tile (None if not available)
+    def getReducedTiles(self, level, x_range, y_range, shift, req_type, cb=None, allow_fake=True):
+        if shift == 0:
+            return self.getTiles(level, x_range, y_range, req_type, cb, allow_fake)
+        self.__loadReducedTilesFromDisk(level, x_range, y_range, shift)
+
+        tiles = {}
+        for x in x_range:
+            for y in y_range:
+                tiles[(x, y)] = self.getReducedTile(level, x, y, shift, req_type, cb, allow_fake)
+        return tiles
+
+    # return if the tile is in the bounds and the coverage polygon of the map
+    def isInCoverage(self, level, x, y):
+        return self.__coverage.contains(level, x, y)
+
+    # return if the tile is in the disk cache.
+    # query the disk if unknown by the index, which may be still building.
+    def isTileInDisk(self, level, x, y):
+        is_in_disk = self.__disk_cache.contains(level, x, y)
+        if is_in_disk is None:
+            data, ts = self.__disk_cache.get(level, x, y)
+            is_in_disk = data is not None
+        return is_in_disk
+
+    # seconds until the circuit of the tile's host lets requests through, or None if the circuit is closed.
+    # the sync requests fail at once while the circuit is not closed.
+    def getHostOpenTime(self, level, x, y):
+        return self.__executor.getHostOpenTime(self.getTileHost(level, x, y))
+
+class DownloadExecutor:
+    """
+    The long-lived download workers shared by all tile agents.
+    The workers take download jobs from the registered agents in turn, bounded by
+    the number of the workers (max works in total) and the max works per host.
+    """
+    PROBE_WAIT = 0.1  #seconds to check again if the probe to the host is done
+
+    __instance = None
+    __instance_lock = Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls.__instance = DownloadExecutor(conf.DL_MAX_WORKS, conf.DL_MAX_HOST_WORKS)
+            return cls.__instance
+
+    def __init__(self, max_works, max_host_works):
+        self.__max_works = max_works
+        self.__max_host_works = max_host_works
+
+        self.__lock = Lock()
+        self.__cv = Condition(self.__lock)
+        self.__agents = []
+        self.__next_agent = 0   #round robin
+        self.__host_works = {}  #host -> number of running jobs
+        self.__host_healths = {}  #host -> HostHealth
+        self.__waiting_hosts = set()  #the hosts refused by health when popping jobs, which have jobs queued
+        self.__granted = None   #(host, ticket) granted when popping a job
+        self.__bg_works = 0   #the running prefetch/refresh jobs
+        self.__max_bg_works = max(1, max_works // 2)  #keep workers for the requested jobs
+        self.__workers = []
+
+    def register(self, agent):
+        with self.__cv:
+            if agent not in self.__agents:
+                self.__agents.append(agent)
+
+            #start workers lazily
+            while len(self.__workers) < self.__max_works:
+                worker = Thread(name="tile-dl-%d" % len(self.__workers), target=self.__runWorker, daemon=True)
+                self.__workers.append(worker)
+                worker.start()
+
+            self.__cv.notify_all()
+
+    def unregister(self, agent):
+        with self.__cv:
+            if agent in self.__agents:
+                self.__agents.remove(agent)
+
+    #notify the workers that some agent has new requests
+    def notify(self, n=1):
+        with self.__cv:
+            self.__cv.notify(n)
+
+    def __getHostHealth(self, host):
+        health = self.__host_healths.get(host)
+        if health is None:
+            health = HostHealth(host)
+            self.__host_healths[host] = health
+        return health
+
+    #NOTICE: should hold __cv. A token of the host is taken if free, and kept in __granted for the job.
+    def __isHostFree(self, host):
+        if self.__host_works.get(host, 0) >= self.__max_host_works:
+            return False  #notified as the running job is done
+        wait_time, ticket = self.__getHostHealth(host).acquire()
+        if wait_time == 0:
+            self.__granted = (host, ticket)
+            return True
+        self.__waiting_hosts.add(host)
+        return False
+
+    #seconds to wait until some host with jobs queued may be available, or None
+    #NOTICE: should hold __cv, and called right after __popJob()
+    def __getHostsWaitTime(self):
+        wait_times = [self.__host_healths[host].getWaitTime() for host in self.__waiting_hosts]
+        wait_times = [t for t in wait_times if t is not None]
+        return max(0.01, min(wait_times)) if wait_times else None
+
+    # For the download not by the workers.
+    # Wait until the host accepts one more request, return the ticket to report and release the request,
+    # or None if the host is down (the circuit is open). If the circuit is half open, wait for the result of the probe.
+    def acquireHost(self, host):
+        with self.__cv:
+            health = self.__getHostHealth(host)
+        while True:
+            wait_time, ticket = health.acquire()
+            if wait_time is None:
+                if health.getOpenTime() != 0:
+                    return None
+                wait_time = self.PROBE_WAIT
+            if wait_time == 0:
+                return ticket
+            time.sleep(wait_time)
+
+    #the request of acquireHost() is done
+    def releaseHost(self, host, ticket):
+        with self.__cv:
+            self.__getHostHealth(host).release(ticket)
+            self.__cv.notify_all()  #the probe may be released
+
+    #see HostHealth.getOpenTime()
+    def getHostOpenTime(self, host):
+        with self.__cv:
+            health = self.__getHostHealth(host)
+        return health.getOpenTime()
+
+    #report the result of the request of @ticket to the host
+    def reportHost(self, host, is_ok, ticket):
+        with self.__cv:
+            health = self.__getHostHealth(host)
+            is_changed = health.report(is_ok, ticket)
+            if is_changed:
+                self.__cv.notify_all()
+
+    #return (host, job, job_type, ticket), the requested jobs of all agents first, then prefetch, then refresh
+    def __popJob(self):
+        self.__waiting_hosts.clear()
+        n = len(self.__agents)
+        for job_type in (TileAgent.JOB_REQUEST, TileAgent.JOB_PREFETCH, TileAgent.JOB_REFRESH):
+            if job_type != TileAgent.JOB_REQUEST and self.__bg_works >= self.__max_bg_works:
+                break
+            for i in range(n):
+                idx = (self.__next_agent + i) % n
+                self.__granted = None
+                job = self.__agents[idx].popDownloadJob(self.__isHostFree, job_type)
+                granted, self.__granted = self.__granted, None
+                if job is not None:
+                    self.__next_agent = (idx + 1) % n
+                    return job + (job_type, granted[1])
+                if granted is not None:  #granted but no job, not to hold the probe
+                    self.__host_healths[granted[0]].release(granted[1])
+        return None
+
+    def __runWorker(self):
+        while True:
+            #wait for a job
+            with self.__cv:
+                job = self.__popJob()
+                while job is None:
+                    self.__cv.wait(self.__getHostsWaitTime())  #wake up if some host is available
+                    job = self.__popJob()
+                host, run, job_type, ticket = job
+                self.__host_works[host] = self.__host_works.get(host, 0) + 1
+                is_bg = job_type != TileAgent.JOB_REQUEST
+                if is_bg:
+                    self.__bg_works += 1
+
+            #do the job
+            try:
+                run(ticket)
+            except Exception as ex:
+                logging.error("download job to '%s' error: %s" % (host, str(ex)))
+
+            #release the host, and let other workers check the jobs
+            with self.__cv:
+                self.__getHostHealth(host).release(ticket)
+                if is_bg:
+                    self.__bg_works -= 1
+                works = self.__host_works[host] - 1
+                if works:
+                    self.__host_works[host] = works
+                else:
+                    del self.__host_works[host]
+                self.__cv.notify_all()
+
+class HostHealth:
+    """
+    The health of a tile server, shared by the agents.
+    A token bucket limits the request rate. After continuous failures, the circuit opens to pause
+    all requests to the host; after a backoff delay, one request is let through as a probe (half open),
+    which closes the circuit if ok, or opens it again with a doubled delay if failed.
+    A granted request holds a ticket (the times the circuit opened, is the probe), so that only the probe
+    changes the half-open circuit, and the results of the requests started before the circuit opened are ignored.
+    """
+    CLOSED    = 0
+    OPEN      = 1
+    HALF_OPEN = 2
+
+    @property
+    def state(self): return self.__state
+
+    def __init__(self, host):
+        self.__host = host
+        self.__lock = Lock()
+
+        self.__state = self.CLOSED
+        self.__failures = 0     #continuous failures
+        self.__trips = 0        #continuous circuit open times
+        self.__opens = 0        #total circuit open times, to tell the requests started before the circuit opened
+        self.__open_until = 0
+        self.__is_probing = False
+
+        #token bucket
+        self.__rate = conf.DL_HOST_RATE
+        self.__tokens = max(1, self.__rate)
+        self.__tokens_ts = time.time()
+
+    #NOTICE: should hold __lock
+    def __refill(self, now):
+        if self.__rate:
+            self.__tokens = min(max(1, self.__rate), self.__tokens + (now - self.__tokens_ts) * self.__rate)
+        self.__tokens_ts = now
+
+    # Take a token to request.
+    # return (wait_time, ticket): wait_time is 0 if ok, seconds to wait for a token, or None if the circuit is open;
+    # the ticket is of the granted request, to report() and release() it.
+    def acquire(self):
+        with self.__lock:
+            now = time.time()
+            if self.__state == self.OPEN:
+                if now < self.__open_until:
+                    return (None, None)
+                self.__state = self.HALF_OPEN
+                logging.info("host '%s' circuit half open, probing" % (self.__host,))
+            if self.__state == self.HALF_OPEN:
+                if self.__is_probing:
+                    return (None, None)
+                self.__is_probing = True
+                return (0, (self.__opens, True))
+
+            if self.__rate:
+                self.__refill(now)
+                if self.__tokens < 1:
+                    return ((1 - self.__tokens) / self.__rate, None)
+                self.__tokens -= 1
+            return (0, (self.__opens, False))
+
+    #NOTICE: should hold __lock
+    def __isProbe(self, ticket):
+        return self.__state == self.HALF_OPEN and self.__is_probing and ticket == (self.__opens, True)
+
+    # the request of @ticket is done, which lets another probe through if it is the probe not reported
+    def release(self, ticket):
+        with self.__lock:
+            if self.__isProbe(ticket):
+                self.__is_probing = False
+
+    # seconds to wait until the host is available again, or None if available or down for no specific time.
+    # the open circuit turns half open once the delay is passed, and 0 is returned to probe it.
+    def getWaitTime(self):
+        with self.__lock:
+            now = time.time()
+            if self.__state == self.OPEN:
+                if now < self.__open_until:
+                    return self.__open_until - now
+                self.__state = self.HALF_OPEN
+                logging.info("host '%s' circuit half open, probing" % (self.__host,))
+                return 0
+            if self.__state == self.CLOSED and self.__rate:
+                self.__refill(now)
+                if self.__tokens < 1:
+                    return (1 - self.__tokens) / self.__rate
+            return None
+
+    # seconds until the circuit lets a request through, 0 if half open, or None if closed
+    def getOpenTime(self):
+        with self.__lock:
+            if self.__state == self.CLOSED:
+                return None
+            if self.__state == self.OPEN:
+                return max(0, self.__open_until - time.time())
+            return 0
+
+    # report the result of the request of @ticket, return True if the circuit state is changed
+    def report(self, is_ok, ticket):
+        with self.__lock:
+            state = self.__state
+            if ticket[0] != self.__opens:
+                return False  #started before the circuit opened
+            if state != self.CLOSED and not self.__isProbe(ticket):
+                return False
+            if is_ok:
+                self.__failures = 0
+                self.__trips = 0
+                self.__is_probing = False
+                self.__state = self.CLOSED
+                if state != self.CLOSED:
+                    logging.warning("host '%s' circuit closed" % (self.__host,))
+            else:
+                self.__failures += 1
+                if state == self.HALF_OPEN or self.__failures >= conf.DL_BREAKER_FAILS:
+                    self.__trips += 1
+                    self.__opens += 1
+                    delay = min(conf.DL_BREAKER_DELAY * (2 ** (self.__trips - 1)), conf.DL_BREAKER_MAX_DELAY)
+                    self.__open_until = time.time() + delay
+                    self.__is_probing = False
+                    self.__state = self.OPEN
+                    logging.warning("host '%s' circuit open for %d seconds" % (self.__host, delay))
+            return state != self.__state
+
+class RequestCancelled(Exception):
+    pass
+
+class ConnectionPool:
+    """
+    Persistent HTTP/1.1 connections, pooled per host (scheme, host, port, proxy).
+    A request reuses an idle connection of the host if any, or opens a new one.
+    At most @max_conns idle connections are kept alive for each host.
+    The proxies of the system (HTTP(S)_PROXY, NO_PROXY, or the registry on Windows) are honoured
+    as urlopen does: http is requested with the absolute url to the proxy, and https is tunneled.
+    """
+    MAX_REDIRECTS = 5
+    REDIRECT_STATUS = (301, 302, 303, 307, 308)
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, max_conns, timeout=30, headers=None):
+        self.__max_conns = max_conns
+        self.__timeout = timeout
+        self.__headers = headers if headers is not None else {'User-Agent': 'Mozilla/5.0'}
+        self.__idle_conns = {}  #host key -> [conn, ...]
+        self.__lock = Lock()
+        self.__is_closed = False
+        self.__proxies = getproxies()  #scheme -> proxy url
+        self.__host_proxies = {}  #(scheme, host) -> proxy, or None if not by proxy
+
+    @classmethod
+    def parseUrl(cls, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise ValueError("not supported url scheme '%s'" % (scheme,))
+
+        port = parts.port if parts.port else (443 if scheme == "https" else 80)
+        path = parts.path if parts.path else "/"
+        if parts.query:
+            path += "?" + parts.query
+        return (scheme, parts.hostname, port), path
+
+    #the proxy url to (host, port, headers), where headers are the Proxy-Authorization if any
+    @classmethod
+    def parseProxy(cls, proxy):
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        parts = urlsplit(proxy)
+        headers = ()
+        if parts.username is not None:
+            auth = "%s:%s" % (unquote(parts.username), unquote(parts.password or ""))
+            headers = (("Proxy-Authorization", "Basic " + base64.b64encode(auth.encode()).decode("ascii")),)
+        return (parts.hostname, parts.port if parts.port else 80, headers)
+
+    # the proxy to request the host, or None
+    def __getProxy(self, scheme, host):
+        try:
+            return self.__host_proxies[(scheme, host)]
+        except KeyError:
+            pass
+
+        proxy = self.__proxies.get(scheme)
+        if proxy and not proxy_bypass(host):
+            proxy = self.parseProxy(proxy)
+        else:
+            proxy = None
+        with self.__lock:
+            self.__host_proxies[(scheme, host)] = proxy
+        return proxy
+
+    def __acquire(self, key):
+        with self.__lock:
+            conns = self.__idle_conns.get(key)
+            if conns:
+                return conns.pop(), True
+
+        scheme, host, port, proxy = key
+        if proxy is None:
+            if scheme == "https":
+                return HTTPSConnection(host, port, timeout=self.__timeout), False
+            return HTTPConnection(host, port, timeout=self.__timeout), False
+
+        proxy_host, proxy_port, proxy_headers = proxy
+        if scheme == "https":
+            conn = HTTPSConnection(proxy_host, proxy_port, timeout=self.__timeout)
+            conn.set_tunnel(host, port, headers=dict(proxy_headers))
+        else:
+            conn = HTTPConnection(proxy_host, proxy_port, timeout=self.__timeout)
+        return conn, False
+
+    def __release(self, key, conn):
+        with self.__lock:
+            if not self.__is_closed:
+                conns = self.__idle_conns.setdefault(key, [])
+                if len(conns) < self.__max_conns:
+                    conns.append(conn)
+                    return
+        conn.close()
+
+    @classmethod
+    def __readBody(cls, res, is_cancelled):
+        if is_cancelled is None:
+            return res.read()
+
+        chunks = []
+        while True:
+            if is_cancelled():
+                raise RequestCancelled()
+            chunk = res.read(cls.CHUNK_SIZE)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    def __request(self, key, path, headers, is_cancelled):
+        while True:
+            conn, is_reused = self.__acquire(key)
+            try:
+                conn.request("GET", path, headers=headers)
+                res = conn.getresponse()
+                data = self.__readBody(res, is_cancelled)
+            except Exception as ex:
+                conn.close()
+                #the idle connection may be closed by the server, retry with a new one
+                if is_reused and isinstance(ex, (ConnectionError, BadStatusLine)):
+                    logging.debug("reused connection to %s is broken, reconnect" % (key[1],))
+                    continue
+                raise ex
+
+            if res.will_close:
+                conn.close()
+            else:
+                self.__release(key, conn)
+            return res.status, res.msg, data
+
+    # return (status, headers, data) of the response.
+    # raise RequestCancelled if @is_cancelled() is true before the response is read completely.
+    def request(self, url, headers=None, is_cancelled=None):
+        _headers = dict(self.__headers)
+        if headers:
+            _headers.update(headers)
+
+        for i in range(self.MAX_REDIRECTS + 1):
+            if is_cancelled is not None and is_cancelled():
+                raise RequestCancelled()
+            (scheme, host, port), path = self.parseUrl(url)
+            proxy = self.__getProxy(scheme, host)
+            key = (scheme, host, port, proxy)
+            req_headers = _headers
+            if proxy and scheme == "http":
+                #to the proxy, by the absolute url
+                path = "http://%s%s%s" % (host, ":%d" % port if port != 80 else "", path)
+                req_headers = dict(_headers)
+                req_headers.update(proxy[2])
+            status, res_headers, data = self.__request(key, path, req_headers, is_cancelled)
+            location = res_headers.get("Location")
+            if status not in self.REDIRECT_STATUS or not location:
+                return status, res_headers, data
+            url = urljoin(url, location)
+
+        raise IOError("too many redirects")
+
+    def close(self):
+        with self.__lock:
+            self.__is_closed = True
+            idle_conns, self.__idle_conns = self.__idle_conns, {}
+
+        for conns in idle_conns.values():
+            for conn in conns:
+                conn.close()
+
 class MemoryCache:
     '''
-    class Item:
-        self.__init__(data=None, status=None, timestamp=None):
-        self.data = data
-        self.status = status
-        self.timestamp = timestamp
+    LRU cache bounded by the size of decoded data in bytes.
+    The cached item is (data, status, timestamp), and the item without data (as a failed or
+    not-in-disk status) expires after @neg_ttl seconds.
+    For concurrency, items are split into shards by id, each with its own lock.
     '''
+    SHARDS = 8
+    NO_DATA_SIZE = 64  #nominal size of the item without data
 
     @property
     def is_concurrency(self):
-        return self.__repo_lock is not None
+        return self.__repo_locks[0] is not None
 
-    def __init__(self, init_status, is_concurrency=False):
+    def __init__(self, init_status, is_concurrency=False, max_bytes=0, neg_ttl=0):
+        n = self.SHARDS if is_concurrency else 1
         self.__init_status = init_status
-        self.__repo = {}
-        self.__repo_lock = Lock() if is_concurrency else None
+        self.__max_bytes = max_bytes // n  #per shard, 0 for unlimited
+        self.__neg_ttl = neg_ttl
+        self.__repos = [OrderedDict() for i in range(n)]  #id -> (data, status, timestamp, size)
+        self.__repo_sizes = [0] * n
+        self.__repo_locks = [Lock() if is_concurrency else None for i in range(n)]
 
-    def __set(self, id, status, data):
-        if data is None:      #using old data
-            item = self.__repo.get(id)
-            if item is not None:
+    @classmethod
+    def sizeOf(cls, data):
+        if data is None:
+            return cls.NO_DATA_SIZE
+        if isinstance(data, Image.Image):
+            w, h = data.size
+            return w * h * len(data.getbands())
+        return len(data)
+
+    def __set(self, shard, id, status, data):
+        repo = self.__repos[shard]
+
+        item = repo.pop(id, None)
+        if item is not None:
+            self.__repo_sizes[shard] -= item[3]
+            if data is None:  #using old data
                 data = item[0]
-        self.__repo[id] = (data, status, time.time())
 
-    def __get(self, id):
-        item = self.__repo.get(id)
+        size = self.sizeOf(data)
+        repo[id] = (data, status, time.time(), size)
+        self.__repo_sizes[shard] += size
+
+        #evict the least recently used
+        if self.__max_bytes:
+            while self.__repo_sizes[shard] > self.__max_bytes:
+                old_id, old_item = repo.popitem(last=False)
+                self.__repo_sizes[shard] -= old_item[3]
+                if old_id == id:
+                    break
+
+    def __get(self, shard, id):
+        repo = self.__repos[shard]
+
+        item = repo.get(id)
         if item is None:
-            item = (None, self.__init_status, time.time())
-            self.__repo[id] = item
-        return item
+            return (None, self.__init_status, time.time())
+
+        data, status, ts, size = item
+        if data is None and self.__neg_ttl and (time.time() - ts) > self.__neg_ttl:
+            del repo[id]
+            self.__repo_sizes[shard] -= size
+            return (None, self.__init_status, time.time())
+
+        repo.move_to_end(id)
+        return (data, status, ts)
 
     def set(self, id, status, data=None):
-        if self.is_concurrency:
-            with self.__repo_lock:
-                self.__set(id, status, data)
+        shard = hash(id) % len(self.__repos)
+        lock = self.__repo_locks[shard]
+        if lock is not None:
+            with lock:
+                self.__set(shard, id, status, data)
         else:
-            self.__set(id, status, data)
+            self.__set(shard, id, status, data)
 
     def get(self, id):
-        if self.is_concurrency:
-            with self.__repo_lock:
-                return self.__get(id)
+        shard = hash(id) % len(self.__repos)
+        lock = self.__repo_locks[shard]
+        if lock is not None:
+            with lock:
+                return self.__get(shard, id)
         else:
-            return self.__get(id)
+            return self.__get(shard, id)
+
+    def __remove(self, shard, id):
+        item = self.__repos[shard].pop(id, None)
+        if item is not None:
+            self.__repo_sizes[shard] -= item[3]
+
+    def remove(self, id):
+        shard = hash(id) % len(self.__repos)
+        lock = self.__repo_locks[shard]
+        if lock is not None:
+            with lock:
+                self.__remove(shard, id)
+        else:
+            self.__remove(shard, id)
+
+class TileIndex:
+    """ The presence of the tiles in a disk cache, to answer misses without querying the disk.
+        Per level, the tiles are kept as a sorted array of packed (x, y) keys; the tiles added
+        after (or during) the building are kept in a set. """
+
+    def __init__(self):
+        self.__levels = {}     #level -> array('Q') of sorted keys
+        self.__added = set()   #(level, key)
+        self.__is_ready = False
+        self.__lock = Lock()
+
+    @property
+    def is_ready(self):
+        return self.__is_ready
+
+    @classmethod
+    def packKey(cls, x, y):
+        return (x << 32) | y
+
+    #@tiles: iterable of (level, x, y), @is_cancelled: to stop the building
+    def build(self, tiles, is_cancelled=None):
+        keys = {}
+        for i, (level, x, y) in enumerate(tiles):
+            if is_cancelled and (i & 0xFFF) == 0 and is_cancelled():
+                return False
+            keys.setdefault(level, []).append(self.packKey(x, y))
+
+        levels = {}
+        for level, level_keys in keys.items():
+            level_keys.sort()
+            levels[level] = array('Q', level_keys)
+
+        with self.__lock:
+            self.__levels = levels
+            self.__is_ready = True
+        return True
+
+    def add(self, level, x, y):
+        with self.__lock:
+            self.__added.add((level, self.packKey(x, y)))
+
+    #return True/False, or None if the index is not ready
+    def contains(self, level, x, y):
+        if not self.__is_ready:
+            return None
+
+        key = self.packKey(x, y)
+        with self.__lock:
+            if (level, key) in self.__added:
+                return True
+            keys = self.__levels.get(level)
+
+        if not keys:
+            return False
+        i = bisect.bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
 
 class DiskCache:
     def start(self):
@@ -663,12 +2132,37 @@ class DiskCache:
     def close(self):
         pass
 
-    def put(self, level, x, y, data):
+    # @etag, @last_modified: the validators from the server, to revalidate the tile
+    def put(self, level, x, y, data, etag=None, last_modified=None):
         pass
 
     def get(self, level, x, y):
         pass
 
+    # renew the timestamp of the tile
+    def touch(self, level, x, y):
+        pass
+
+    # return (etag, last_modified) of the tile
+    def getValidators(self, level, x, y):
+        return (None, None)
+
+    # record the tile not existing in the server, with the http @status
+    def putMissing(self, level, x, y, status):
+        pass
+
+    # return if the tile is recorded not existing in the server, and not expired
+    def isMissing(self, level, x, y):
+        return False
+
+    # return dict of (x, y) -> (data, timestamp) for the tiles in the rectangle
+    def getTiles(self, level, x_range, y_range):
+        pass
+
+    # return if the tile exists, or None if unknown
+    def contains(self, level, x, y):
+        return None
+
 class FileDiskCache(DiskCache):
     def __init__(self, cache_dir, map_desc):
         self.__cache_dir = os.path.join(cache_dir, map_desc.map_id) #create subfolder
@@ -685,12 +2179,17 @@ class FileDiskCache(DiskCache):
     def close(self):
         pass
 
-    def put(self, level, x, y, data):
+    def put(self, level, x, y, data, etag=None, last_modified=None):
         path = self.__genTilePath(level, x, y)
         mkdirSafely(os.path.dirname(path))
         with open(path, 'wb') as file:
             file.write(data)
 
+    def touch(self, level, x, y):
+        path = self.__genTilePath(level, x, y)
+        if os.path.exists(path):
+            os.utime(path)
+
     def get(self, level, x, y):
         path = self.__genTilePath(level, x, y)
         if os.path.exists(path):
@@ -698,7 +2197,44 @@ class FileDiskCache(DiskCache):
                 return file.read()
         return None
 
+    def getTiles(self, level, x_range, y_range):
+        tiles = {}
+        for x in x_range:
+            for y in y_range:
+                data = self.get(level, x, y)
+                if data is not None:
+                    tiles[(x, y)] = (data, None)
+        return tiles
+
 class DBDiskCache(DiskCache):
+    TILES_META_CREATE_SQL = "CREATE TABLE tiles_meta(" + \
+            "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, etag TEXT, last_modified TEXT, " + \
+            "PRIMARY KEY (zoom_level, tile_column, tile_row))"
+    TILES_MISSING_CREATE_SQL = "CREATE TABLE tiles_missing(" + \
+            "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, status INTEGER, timestamp INTEGER, " + \
+            "PRIMARY KEY (zoom_level, tile_column, tile_row))"
+
+    #the deduplicated layout: the tile data is stored once in images, and referred by map.
+    #the view 'tiles' keeps compatible with the readers of the flat table.
+    MAP_CREATE_SQL = "CREATE TABLE map(" + \
+            "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT NOT NULL, timestamp INTEGER NOT NULL, " + \
+            "PRIMARY KEY (zoom_level, tile_column, tile_row))"
+    MAP_IDX_CREATE_SQL = "CREATE INDEX map_tile_id_idx on map(tile_id)"
+    IMAGES_CREATE_SQL = "CREATE TABLE images(tile_id TEXT PRIMARY KEY, tile_data BLOB NOT NULL)"
+    TILES_VIEW_CREATE_SQL = "CREATE VIEW tiles AS SELECT " + \
+            "map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, " + \
+            "images.tile_data AS tile_data, map.timestamp AS timestamp " + \
+            "FROM map JOIN images ON images.tile_id = map.tile_id"
+    MIGRATE_BATCH = 500  #tiles to migrate in one transaction
+    TILES_ACCESS_CREATE_SQL = "CREATE TABLE tiles_access(" + \
+            "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, access INTEGER, " + \
+            "PRIMARY KEY (zoom_level, tile_column, tile_row))"
+    ACCESS_BUCKET = 60  #seconds, the granularity of the LRU eviction
+    ACCESS_FLUSH_PERIOD = 60    #seconds, to flush the access records even if no tile is put
+    ACCESS_FLUSH_SIZE = 4096    #access records to flush at once
+    FLUSH_RETRY_LIMIT = 5    #times to retry a failed batch write, before dropping it
+    FLUSH_RETRY_DELAY = 1.0  #seconds before retrying a failed batch write, doubled for each retry
+
     @property
     def map_id(self):
         return self.__map_desc.map_id
@@ -711,24 +2247,46 @@ class DBDiskCache(DiskCache):
         #configs
         self.__db_schema = db_schema
         self.__has_timestamp = True
+        self.__has_meta = True    #the table of tile validators
+        self.__has_missing = True #the table of the tiles not existing in the server
+        self.__has_access = True  #the table of the last access time of tiles
+        self.__is_dedup = False   #the deduplicated layout
+        self.__migrate_rowid = None  #the last rowid of the flat table migrated, None if not migrating
+        self.__is_migrating = True   #to migrate to the dedup layout when started
 
         self.__is_concurrency = is_concurrency
 
-        if is_concurrency:
-            self.__surrogate = None  #the thread do All DB operations, due to sqlite3 requiring only the same thread.
+        #the presence of tiles, to skip querying the missing tiles
+        self.__index = TileIndex()
 
-            self.__is_closed = False
+        #the tiles not existing in the server, loaded with the index
+        self.__missing = {}   #packed key -> timestamp
+        self.__missing_lock = Lock()
 
-            #concurrency get/put
-            self.__sql_queue = []
-            self.__sql_queue_lock = Lock()
-            self.__sql_queue_cv = Condition(self.__sql_queue_lock)
+        #write-behind: the tiles to put, flushed to db in one transaction
+        self.__pending = OrderedDict()   #(level, x, y) -> (data, timestamp, etag, last_modified), data is None to touch
+        self.__pending_since = None      #the time of the oldest pending tile
+        self.__flushing = None           #the pending tiles in writing, still readable until committed
+        self.__pending_missing = {}      #(level, x, y) -> (status, timestamp)
+        self.__accessed = {}             #(level, x, row) -> timestamp, in the db coordinates
+        self.__accessed_since = None     #the time of the oldest access record
+        self.__flush_failures = 0        #continuous failures to write the pending, which are retried later
+        self.__flush_retry_time = None   #not to flush before the time, after a failure
+        self.__pending_lock = Lock()
 
-            self.__get_lock = Lock()    #block the 'get' action
+        if is_concurrency:
+            self.__surrogate = None  #the thread do All DB writes, due to sqlite3 requiring only the same thread.
+            self.__ready = Event()   #set after the surrogate opened the db
 
-            self.__get_respose = None   #the pair (data, exception)
-            self.__get_respose_lock = Lock()
-            self.__get_respose_cv = Condition(self.__get_respose_lock)
+            self.__is_closed = False
+            self.__indexer = None    #the thread building the tile index
+            self.__write_lock = Lock()
+            self.__write_cv = Condition(self.__write_lock)
+
+            #read-only connections for concurrent gets, each used by one thread at a time
+            self.__readers = []
+            self.__idle_readers = []
+            self.__readers_lock = Lock()
 
     def __initDB(self):
         def getBoundsText(map_desc):
@@ -764,8 +2322,18 @@ class DBDiskCache(DiskCache):
 
         #exec
         conn.execute(meta_create_sql)
-        conn.execute(tiles_create_sql)
-        conn.execute(tiles_idx_create_sql)
+        if conf.DB_DEDUP:
+            conn.execute(self.MAP_CREATE_SQL)
+            conn.execute(self.MAP_IDX_CREATE_SQL)
+            conn.execute(self.IMAGES_CREATE_SQL)
+            conn.execute(self.TILES_VIEW_CREATE_SQL)
+            self.__is_dedup = True
+        else:
+            conn.execute(tiles_create_sql)
+            conn.execute(tiles_idx_create_sql)
+        conn.execute(self.TILES_META_CREATE_SQL)
+        conn.execute(self.TILES_MISSING_CREATE_SQL)
+        conn.execute(self.TILES_ACCESS_CREATE_SQL)
         for sql in meta_data_sqls:
             conn.execute(sql)
         conn.commit()
@@ -805,15 +2373,106 @@ class DBDiskCache(DiskCache):
 
         self.__has_timestamp = self.__tableHasColumn("tiles", "timestamp")
 
+        #the tables added later
+        try:
+            with self.__conn:
+                self.__conn.execute(self.TILES_META_CREATE_SQL.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS"))
+        except Exception as ex:
+            logging.warning("[%s] Create table tiles_meta error: %s" % (self.map_id, str(ex)))
+            self.__has_meta = False
+        try:
+            with self.__conn:
+                self.__conn.execute(self.TILES_MISSING_CREATE_SQL.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS"))
+        except Exception as ex:
+            logging.warning("[%s] Create table tiles_missing error: %s" % (self.map_id, str(ex)))
+            self.__has_missing = False
+        try:
+            with self.__conn:
+                self.__conn.execute(self.TILES_ACCESS_CREATE_SQL.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS"))
+        except Exception as ex:
+            logging.warning("[%s] Create table tiles_access error: %s" % (self.map_id, str(ex)))
+            self.__has_access = False
+
+        #the layout
+        row = self.__conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+        self.__is_dedup = row is not None and row[0] == 'view'
+        if not self.__is_dedup and conf.DB_DEDUP and self.__is_migrating:
+            try:
+                self.__beginMigration()
+            except Exception as ex:
+                logging.warning("[%s] Begin the dedup migration error: %s" % (self.map_id, str(ex)))
+
+    @classmethod
+    def __hashTile(cls, data):
+        return hashlib.md5(data).hexdigest()
+
+    #migrate to the deduplicated layout, in batches between the writes of tiles.
+    #the new tiles are written to both layouts during migrating.
+    def __beginMigration(self):
+        with self.__conn:
+            self.__conn.execute(self.MAP_CREATE_SQL.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS"))
+            self.__conn.execute(self.MAP_IDX_CREATE_SQL.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS"))
+            self.__conn.execute(self.IMAGES_CREATE_SQL.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS"))
+        rowid = self.__getMetadata('dedup_migration')  #resume
+        self.__migrate_rowid = int(rowid) if rowid else 0
+        logging.info("[%s] Migrate to the dedup layout from rowid %d" % (self.map_id, self.__migrate_rowid))
+
+    def __migrateStep(self):
+        conn = self.__conn
+        begin = self.__migrate_rowid
+        row = conn.execute("SELECT rowid FROM tiles WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+                (begin, self.MIGRATE_BATCH - 1)).fetchone()
+        end = row[0] if row is not None else None  #None for the last batch
+
+        ts_col = "timestamp" if self.__has_timestamp else "0"
+        cond = "rowid > %d" % (begin,) if end is None else "rowid > %d AND rowid <= %d" % (begin, end)
+        images_sql = "INSERT OR IGNORE INTO images(tile_id, tile_data) " + \
+                "SELECT tile_hash(tile_data), tile_data FROM tiles WHERE " + cond
+        map_sql = "INSERT OR IGNORE INTO map(zoom_level, tile_column, tile_row, tile_id, timestamp) " + \
+                "SELECT zoom_level, tile_column, tile_row, tile_hash(tile_data), %s FROM tiles WHERE %s" % (ts_col, cond)
+
+        with conn:  #commit, or rollback if exception
+            conn.execute(images_sql)
+            conn.execute(map_sql)  #ignore the tiles written to map during migrating, which are newer
+            if end is not None:
+                conn.execute("INSERT OR REPLACE INTO metadata(name, value) VALUES('dedup_migration', ?)", (str(end),))
+            else:
+                #switch to the view in the same transaction, no write is between
+                conn.execute("DROP INDEX IF EXISTS tiles_idx")
+                conn.execute("DROP TABLE tiles")
+                conn.execute(self.TILES_VIEW_CREATE_SQL)
+                conn.execute("DELETE FROM metadata WHERE name='dedup_migration'")
+
+        if end is not None:
+            self.__migrate_rowid = end
+        else:
+            self.__migrate_rowid = None
+            self.__has_timestamp = True
+            self.__is_dedup = True
+            logging.info("[%s] Migrate to the dedup layout [OK]" % (self.map_id,))
+
+    def __connect(self):
+        conn = sqlite3.connect(self.__db_path)
+        conn.create_function("tile_hash", 1, self.__hashTile)
+        try:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")  #only effective for the new db
+            conn.execute("PRAGMA journal_mode=%s" % (conf.DB_JOURNAL_MODE,))
+            conn.execute("PRAGMA synchronous=%s" % (conf.DB_SYNCHRONOUS,))
+            conn.execute("PRAGMA cache_size=%d" % (conf.DB_CACHE_SIZE,))
+            conn.execute("PRAGMA mmap_size=%d" % (conf.DB_MMAP_SIZE,))
+        except Exception as ex:
+            logging.warning("[%s] Set db pragmas error: %s" % (self.map_id, str(ex)))
+        return conn
+
     #the true actions which are called by Surrogate
     def __start(self):
         if not os.path.exists(self.__db_path):
             logging.info("[%s] Initializing local cache DB..." % (self.map_id,))
             mkdirSafely(os.path.dirname(self.__db_path))
-            self.__conn = sqlite3.connect(self.__db_path)
+            self.__conn = self.__connect()
             self.__initDB()
         else:
-            self.__conn = sqlite3.connect(self.__db_path)
+            self.__conn = self.__connect()
             self.__readConfig()
 
         logging.info("[%s][Config] db schema: %s" % (self.map_id, self.__db_schema))
@@ -821,35 +2480,279 @@ class DBDiskCache(DiskCache):
 
     def __close(self):
         logging.info("[%s] Closing local cache DB..." % (self.map_id,))
+        try:
+            #flush durably
+            self.__conn.execute("PRAGMA synchronous=FULL")
+            self.__flush()
+            self.__conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as ex:
+            logging.error("[%s] DB flush data error: %s" % (self.map_id, str(ex)))
         self.__conn.close()
 
     @classmethod
     def flipY(cls, y, level):
         return (1 << level) - 1 - y
 
-    def __put(self, level, x, y, data):
-        #sql
-        if self.__db_schema == 'tms':
-            y = self.flipY(y, level)
+    #write all pending tiles in one transaction
+    def __flush(self):
+        with self.__pending_lock:
+            if not self.__pending and not self.__pending_missing and not self.__accessed:
+                return
+            pending, self.__pending = self.__pending, OrderedDict()
+            missing, self.__pending_missing = self.__pending_missing, {}
+            accessed, self.__accessed = self.__accessed, {}
+            self.__pending_since = None
+            self.__accessed_since = None
+            self.__flushing = pending
+
+        try:
+            self.__writeTiles(pending, missing, accessed)
+            with self.__pending_lock:
+                self.__flushing = None
+                self.__flush_failures = 0
+                self.__flush_retry_time = None
+        except Exception as ex:
+            with self.__pending_lock:
+                self.__flushing = None
+                self.__flush_failures += 1
+                if self.__flush_failures > self.FLUSH_RETRY_LIMIT:
+                    logging.error("[%s] Drop the pending data after %d failures to write: %d tiles, %d missing" % \
+                            (self.map_id, self.__flush_failures, len(pending), len(missing)))
+                    self.__flush_failures = 0
+                    self.__flush_retry_time = None
+                else:
+                    self.__requeuePending(pending, missing, accessed)
+                    delay = self.FLUSH_RETRY_DELAY * (2 ** (self.__flush_failures - 1))
+                    self.__flush_retry_time = time.time() + delay
+                    logging.warning("[%s] Failed to write the pending data, retry in %.0f seconds" % (self.map_id, delay))
+            raise ex
+
+    #put the batch failed to write back to the pending, under the data put or touched after it.
+    #NOTICE: should hold __pending_lock
+    def __requeuePending(self, pending, missing, accessed):
+        for key, item in self.__pending.items():
+            old_item = pending.get(key)
+            if item[0] is None and old_item is not None and old_item[0] is not None:
+                item = (old_item[0], item[1]) + old_item[2:]  #touched after put
+            pending[key] = item
+        self.__pending = pending
+
+        missing.update(self.__pending_missing)
+        self.__pending_missing = missing
+
+        for key, ts in accessed.items():
+            self.__accessed[key] = max(ts, self.__accessed.get(key, ts))
+
+        if self.__pending or self.__pending_missing:
+            self.__pending_since = time.time() if self.__pending_since is None else self.__pending_since
+        if self.__accessed:
+            self.__accessed_since = time.time() if self.__accessed_since is None else self.__accessed_since
+
+    def __writeTiles(self, pending, missing, accessed):
+        is_flat = not self.__is_dedup
+        is_dedup = self.__is_dedup or self.__migrate_rowid is not None  #both if migrating
+
+        rows = []
+        map_rows = []
+        images = {}   #tile_id -> data
+        touch_rows = []
+        meta_rows = []
+        meta_del_rows = []
+        missing_rows = []
+        for (level, x, y), (status, ts) in missing.items():
+            if self.__db_schema == 'tms':
+                y = self.flipY(y, level)
+            missing_rows.append((level, x, y, status, ts))
+        for (level, x, y), (data, ts, etag, last_modified) in pending.items():
+            if self.__db_schema == 'tms':
+                y = self.flipY(y, level)
+            if data is None:
+                touch_rows.append((ts, level, x, y))
+                continue
+            rows.append((level, x, y, data, ts) if self.__has_timestamp else (level, x, y, data))
+            if is_dedup:
+                tile_id = self.__hashTile(data)
+                images[tile_id] = data
+                map_rows.append((level, x, y, tile_id, ts))
+            if etag or last_modified:
+                meta_rows.append((level, x, y, etag, last_modified))
+            else:
+                meta_del_rows.append((level, x, y))
 
-        sql = None
         if self.__has_timestamp:
             sql  = "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data, timestamp)"
-            sql += " VALUES(%d, %d, %d, ?, %d)" % (level, x, y, int(time.time()))
+            sql += " VALUES(?, ?, ?, ?, ?)"
         else:
-            sql = "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data)"
-            sql += " VALUES(%d, %d, %d, ?)" % (level, x, y)
+            sql  = "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data)"
+            sql += " VALUES(?, ?, ?, ?)"
+
+        touch_sql = "UPDATE tiles SET timestamp=? WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+        meta_sql  = "INSERT OR REPLACE INTO tiles_meta(zoom_level, tile_column, tile_row, etag, last_modified)"
+        meta_sql += " VALUES(?, ?, ?, ?, ?)"
+        meta_del_sql = "DELETE FROM tiles_meta WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+        missing_sql  = "INSERT OR REPLACE INTO tiles_missing(zoom_level, tile_column, tile_row, status, timestamp)"
+        missing_sql += " VALUES(?, ?, ?, ?, ?)"
+        missing_del_sql = "DELETE FROM tiles_missing WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+        map_id_sql = "SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+        map_sql = "INSERT OR REPLACE INTO map(zoom_level, tile_column, tile_row, tile_id, timestamp) VALUES(?, ?, ?, ?, ?)"
+        map_touch_sql = "UPDATE map SET timestamp=? WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+        images_sql = "INSERT OR IGNORE INTO images(tile_id, tile_data) VALUES(?, ?)"
+        orphan_del_sql = "DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id=images.tile_id)"
+        access_sql = "INSERT OR REPLACE INTO tiles_access(zoom_level, tile_column, tile_row, access) VALUES(?, ?, ?, ?)"
+        if not is_flat:
+            sql = map_sql
 
         #query
         try:
-            self.__conn.execute(sql, (data,))
-            self.__conn.commit()
-            logging.info("[%s] %s [OK]" % (self.map_id, sql))
+            with self.__conn:  #commit, or rollback if exception
+                if is_flat:
+                    self.__conn.executemany(sql, rows)
+                    if self.__has_timestamp and touch_rows:
+                        self.__conn.executemany(touch_sql, touch_rows)
+                if is_dedup:
+                    #the images replaced, to delete if not referred anymore
+                    replaced_ids = set()
+                    for level, x, y, tile_id, ts in map_rows:
+                        row = self.__conn.execute(map_id_sql, (level, x, y)).fetchone()
+                        if row is not None and row[0] != tile_id:
+                            replaced_ids.add(row[0])
+                    self.__conn.executemany(images_sql, images.items())
+                    self.__conn.executemany(map_sql, map_rows)
+                    self.__conn.executemany(map_touch_sql, touch_rows)
+                    self.__conn.executemany(orphan_del_sql, [(tile_id,) for tile_id in replaced_ids])
+                if self.__has_meta:
+                    self.__conn.executemany(meta_sql, meta_rows)
+                    self.__conn.executemany(meta_del_sql, meta_del_rows)
+                if self.__has_missing:
+                    self.__conn.executemany(missing_sql, missing_rows)
+                    self.__conn.executemany(missing_del_sql, [row[:3] for row in rows])
+                if self.__has_access:
+                    self.__conn.executemany(access_sql, [key + (ts,) for key, ts in accessed.items()])
+            logging.info("[%s] %s x %d, touch x %d [OK]" % (self.map_id, sql, len(rows), len(touch_rows)))
         except Exception as ex:
-            logging.info("[%s] %s [Fail]" % (self.map_id, sql))
+            logging.info("[%s] %s x %d, touch x %d [Fail]" % (self.map_id, sql, len(rows), len(touch_rows)))
             raise ex
 
-    def __get(self, level, x, y):
+    #NOTICE: should hold __pending_lock
+    def __isFlushNeeded(self):
+        if self.__flush_retry_time is not None and time.time() < self.__flush_retry_time:
+            return False
+        if len(self.__pending) + len(self.__pending_missing) >= conf.DB_BATCH_SIZE or \
+                len(self.__accessed) >= self.ACCESS_FLUSH_SIZE:
+            return True
+        t = self.__getFlushTime()
+        return t is not None and time.time() >= t
+
+    #the time to flush by the age of the pending, or None if nothing pending
+    #NOTICE: should hold __pending_lock
+    def __getFlushTime(self):
+        times = []
+        if self.__pending_since is not None:
+            times.append(self.__pending_since + conf.DB_BATCH_PERIOD.total_seconds())
+        if self.__accessed_since is not None:
+            times.append(self.__accessed_since + self.ACCESS_FLUSH_PERIOD)
+        return min(times) if times else None
+
+    #seconds to wait before flushing, or None if nothing pending
+    #NOTICE: should hold __pending_lock
+    def __getFlushTimeout(self):
+        t = self.__getFlushTime()
+        if t is None:
+            return None
+        if self.__flush_retry_time is not None:
+            t = max(t, self.__flush_retry_time)
+        return max(0, t - time.time())
+
+    def __buildIndex(self, conn):
+        is_tms = self.__db_schema == 'tms'
+        table = "map" if self.__is_dedup else "tiles"  #no need to join the images
+        def tiles():
+            for level, x, y in conn.execute("SELECT zoom_level, tile_column, tile_row FROM %s" % (table,)):
+                yield (level, x, self.flipY(y, level) if is_tms else y)
+
+        is_cancelled = (lambda: self.__is_closed) if self.__is_concurrency else None
+        t = time.time()
+        try:
+            if self.__index.build(tiles(), is_cancelled):
+                logging.info("[%s] Build tile index [OK][%.2fs]" % (self.map_id, time.time() - t))
+        except Exception as ex:
+            logging.warning("[%s] Build tile index error: %s" % (self.map_id, str(ex)))
+
+        if self.__has_missing:
+            try:
+                self.__loadMissing(conn)
+            except Exception as ex:
+                logging.warning("[%s] Load missing tiles error: %s" % (self.map_id, str(ex)))
+
+    @classmethod
+    def __packKey(cls, level, x, y):
+        return (level << 60) | (x << 30) | y
+
+    def __loadMissing(self, conn):
+        is_tms = self.__db_schema == 'tms'
+        since = int(time.time()) - conf.TILE_MISSING_EXPIRE
+        sql = "SELECT zoom_level, tile_column, tile_row, timestamp FROM tiles_missing WHERE timestamp > %d" % (since,)
+        missing = {}
+        for level, x, y, ts in conn.execute(sql):
+            if is_tms:
+                y = self.flipY(y, level)
+            missing[self.__packKey(level, x, y)] = ts
+        with self.__missing_lock:
+            missing.update(self.__missing)  #the newer
+            self.__missing = missing
+        logging.info("[%s] Load missing tiles [OK][%d]" % (self.map_id, len(missing)))
+
+    def __runIndexer(self):
+        try:
+            conn = self.__acquireReader()
+        except Exception as ex:
+            logging.warning("[%s] Build tile index error: %s" % (self.map_id, str(ex)))
+            return
+        try:
+            self.__buildIndex(conn)
+        finally:
+            self.__releaseReader(conn)
+
+    #add to pending, return if it is time to flush
+    #@data is None to touch the tile
+    def __put(self, level, x, y, data, ts, etag=None, last_modified=None):
+        if data is not None:
+            self.__index.add(level, x, y)
+            if self.__missing:
+                with self.__missing_lock:
+                    self.__missing.pop(self.__packKey(level, x, y), None)
+        key = (level, x, y)
+        with self.__pending_lock:
+            item = self.__pending.pop(key, None)  #keep the order of the latest put
+            if data is None and item is not None and item[0] is not None:
+                data, etag, last_modified = item[0], item[2], item[3]  #touch the pending tile
+            self.__pending[key] = (data, ts, etag, last_modified)
+            if self.__pending_since is None:
+                self.__pending_since = time.time()
+            return self.__isFlushNeeded()
+
+    #return the pending (data, timestamp, etag, last_modified) of the tile
+    #the data is None if only touched
+    def __getPending(self, level, x, y):
+        key = (level, x, y)
+        with self.__pending_lock:
+            item = self.__pending.get(key)
+            if item is not None and item[0] is None and self.__flushing is not None:
+                flushing_item = self.__flushing.get(key)
+                if flushing_item is not None and flushing_item[0] is not None:
+                    item = (flushing_item[0], item[1]) + flushing_item[2:]  #touched after put
+            if item is None and self.__flushing is not None:
+                item = self.__flushing.get(key)
+        return item
+
+    def __get(self, conn, level, x, y):
+        #not yet written to db
+        item = self.__getPending(level, x, y)
+        if item is not None and item[0] is not None:
+            data, ts = item[:2]
+            return (data, ts if self.__has_timestamp else None)
+        touched_ts = item[1] if item is not None else None
+
         #sql
         if self.__db_schema == 'tms':
             y = self.flipY(y, level)
@@ -861,7 +2764,7 @@ class DBDiskCache(DiskCache):
         row = None
         try:
             #query
-            cursor = self.__conn.execute(sql)
+            cursor = conn.execute(sql)
             row = cursor.fetchone()
         except Exception as ex:
             logging.info("[%s] %s [Fail]" % (self.map_id, sql))
@@ -871,106 +2774,376 @@ class DBDiskCache(DiskCache):
         if row is None:
             logging.info("[%s] %s [NA]" % (self.map_id, sql))
             return (None, None)
-        elif self.__has_timestamp:
+
+        self.__recordAccess(level, ((x, y),))
+        if self.__has_timestamp:
             logging.info("[%s] %s [OK][TS]" % (self.map_id, sql))
-            return row
+            return (row[0], touched_ts) if touched_ts else row
         else:
             logging.info("[%s] %s [OK]" % (self.map_id, sql))
             return (row[0], None)
 
+    #keep the access time of the tiles read from db, which is written with the pending tiles,
+    #or alone after ACCESS_FLUSH_PERIOD or ACCESS_FLUSH_SIZE records.
+    #@keys are (x, row) in the db coordinates.
+    def __recordAccess(self, level, keys):
+        if not self.__has_access or not keys:
+            return
+        now = int(time.time())
+        with self.__pending_lock:
+            is_first = self.__accessed_since is None
+            if is_first:
+                self.__accessed_since = time.time()
+            for x, row in keys:
+                self.__accessed[(level, x, row)] = now
+            is_flush_needed = self.__isFlushNeeded()
+        if not self.__is_concurrency:
+            if is_flush_needed:
+                try:
+                    self.__flush()
+                except Exception as ex:  #not to fail the reading
+                    logging.error("[%s] DB put data error: %s" % (self.map_id, str(ex)))
+        elif is_first or is_flush_needed:
+            #notify the surrogate to flush, or to reset the flush timeout
+            with self.__write_cv:
+                self.__write_cv.notify()
+
+    def __acquireReader(self):
+        self.__ready.wait()  #the db is created and configured by the surrogate
+
+        with self.__readers_lock:
+            if self.__idle_readers:
+                return self.__idle_readers.pop()
+
+        uri = "file:%s?mode=ro" % (pathname2url(self.__db_path),)
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA cache_size=%d" % (conf.DB_CACHE_SIZE,))
+            conn.execute("PRAGMA mmap_size=%d" % (conf.DB_MMAP_SIZE,))
+        except Exception as ex:
+            logging.warning("[%s] Set db pragmas error: %s" % (self.map_id, str(ex)))
+
+        with self.__readers_lock:
+            self.__readers.append(conn)
+        return conn
+
+    def __releaseReader(self, conn):
+        with self.__readers_lock:
+            self.__idle_readers.append(conn)
+
+    def __closeReaders(self):
+        with self.__readers_lock:
+            readers, self.__readers, self.__idle_readers = self.__readers, [], []
+        for conn in readers:
+            conn.close()
+
+    def __getTiles(self, conn, level, x_range, y_range):
+        if not x_range or not y_range:
+            return {}
+
+        #sql
+        col_min, col_max = x_range[0], x_range[-1]
+        row_min, row_max = y_range[0], y_range[-1]
+        if self.__db_schema == 'tms':
+            row_min, row_max = self.flipY(row_max, level), self.flipY(row_min, level)
+
+        cols = "tile_column, tile_row, tile_data, timestamp" if self.__has_timestamp else "tile_column, tile_row, tile_data"
+        sql = "SELECT %s FROM tiles WHERE zoom_level=%d AND tile_column BETWEEN %d AND %d AND tile_row BETWEEN %d AND %d" % \
+                (cols, level, col_min, col_max, row_min, row_max)
+
+        rows = None
+        try:
+            #query
+            rows = conn.execute(sql).fetchall()
+        except Exception as ex:
+            logging.info("[%s] %s [Fail]" % (self.map_id, sql))
+            raise ex
+        logging.info("[%s] %s [OK][%d]" % (self.map_id, sql, len(rows)))
+
+        self.__recordAccess(level, [row[:2] for row in rows])
+
+        #result (x, y) -> (tile, timestamp)
+        tiles = {}
+        for row in rows:
+            x, y = row[0], row[1]
+            if self.__db_schema == 'tms':
+                y = self.flipY(y, level)
+            tiles[(x, y)] = (row[2], row[3] if self.__has_timestamp else None)
+
+        #not yet written to db
+        with self.__pending_lock:
+            for pending in (self.__flushing, self.__pending):
+                if not pending:
+                    continue
+                for (level_, x, y), (data, ts, etag, last_modified) in pending.items():
+                    if level_ != level or x not in x_range or y not in y_range:
+                        continue
+                    if data is None:  #touched
+                        data = tiles.get((x, y), (None, None))[0]
+                        if data is None:
+                            continue
+                    tiles[(x, y)] = (data, ts if self.__has_timestamp else None)
+
+        return tiles
+
     #the interface which are called by the user
-    def start(self):
+    #@is_indexing is False to skip the tile index, as for the maintenance
+    #@is_migrating is False to keep the flat layout even if DB_DEDUP, as for the maintenance
+    def start(self, is_indexing=True, is_migrating=True):
+        self.__is_migrating = is_migrating
         if not self.__is_concurrency:
             self.__start()
+            while self.__migrate_rowid is not None:
+                self.__migrateStep()
+            if is_indexing:
+                self.__buildIndex(self.__conn)
         else:
             self.__surrogate = Thread(target=self.__runSurrogate)
             self.__surrogate.start()
+            self.__indexer = Thread(target=self.__runIndexer)
+            self.__indexer.start()
 
     def close(self):
         if not self.__is_concurrency:
-            self.__close()
+            self.__close()  #flush pending data
         else:
-            with self.__sql_queue_cv:
+            with self.__write_cv:
                 self.__is_closed = True
-                self.__sql_queue_cv.notify()
+                self.__write_cv.notify()
             self.__surrogate.join()
+            self.__indexer.join()
+            self.__closeReaders()
+
+    def put(self, level, x, y, data, etag=None, last_modified=None):
+        self.__putPending(level, x, y, data, etag, last_modified)
+
+    def touch(self, level, x, y):
+        self.__putPending(level, x, y, None)
+
+    def putMissing(self, level, x, y, status):
+        ts = int(time.time())
+        with self.__missing_lock:
+            self.__missing[self.__packKey(level, x, y)] = ts
+        if not self.__has_missing:
+            return
+
+        with self.__pending_lock:
+            self.__pending_missing[(level, x, y)] = (status, ts)
+            if self.__pending_since is None:
+                self.__pending_since = time.time()
+            is_flush_needed = self.__isFlushNeeded()
+        if not self.__is_concurrency:
+            if is_flush_needed:
+                self.__flush()
+        else:
+            with self.__write_cv:
+                self.__write_cv.notify()
+
+    def isMissing(self, level, x, y):
+        with self.__missing_lock:
+            ts = self.__missing.get(self.__packKey(level, x, y))
+        return ts is not None and (time.time() - ts) < conf.TILE_MISSING_EXPIRE
 
-    def put(self, level, x, y, data):
+    def __putPending(self, level, x, y, data, etag=None, last_modified=None):
+        is_flush_needed = self.__put(level, x, y, data, int(time.time()), etag, last_modified)
         if not self.__is_concurrency:
-            self.__put(level, x, y, data)
+            if is_flush_needed:
+                self.__flush()
         else:
-            with self.__sql_queue_cv:
-                item = (level, x, y, data)
-                self.__sql_queue.append(item)
-                self.__sql_queue_cv.notify()
+            #notify the surrogate to flush, or to reset the flush timeout
+            with self.__write_cv:
+                self.__write_cv.notify()
 
     def get(self, level, x, y):
         if not self.__is_concurrency:
-            return self.__get(level, x, y)
+            return self.__get(self.__conn, level, x, y)
+        else:
+            conn = self.__acquireReader()
+            try:
+                return self.__get(conn, level, x, y)
+            finally:
+                self.__releaseReader(conn)
+
+    def getTiles(self, level, x_range, y_range):
+        if not self.__is_concurrency:
+            return self.__getTiles(self.__conn, level, x_range, y_range)
         else:
-            def has_respose():
-                return self.__get_respose is not None
-
-            with self.__get_lock:  #for blocking the continuous get
-                #req tile
-                with self.__sql_queue_cv:
-                    item = (level, x, y, None)
-                    self.__sql_queue.insert(0, item)  #service first
-                    self.__sql_queue_cv.notify()
-
-                #wait resposne
-                res = None
-                with self.__get_respose_cv:
-                    self.__get_respose_cv.wait_for(has_respose)
-                    res, self.__get_respose = self.__get_respose, res   #swap: pop response of get()
-
-                #return data
-                data, ex = res
-                if ex:
-                    raise ex
-                return data
-
-    #the Surrogate thread
+            conn = self.__acquireReader()
+            try:
+                return self.__getTiles(conn, level, x_range, y_range)
+            finally:
+                self.__releaseReader(conn)
+
+    def contains(self, level, x, y):
+        return self.__index.contains(level, x, y)
+
+    def __getValidators(self, conn, level, x, y):
+        item = self.__getPending(level, x, y)
+        if item is not None and item[0] is not None:
+            return item[2:]
+        if not self.__has_meta:
+            return (None, None)
+
+        if self.__db_schema == 'tms':
+            y = self.flipY(y, level)
+        sql = "SELECT etag, last_modified FROM tiles_meta WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d" % \
+                (level, x, y)
+        row = conn.execute(sql).fetchone()
+        return row if row is not None else (None, None)
+
+    def getValidators(self, level, x, y):
+        if not self.__is_concurrency:
+            return self.__getValidators(self.__conn, level, x, y)
+        else:
+            conn = self.__acquireReader()
+            try:
+                return self.__getValidators(conn, level, x, y)
+            finally:
+                self.__releaseReader(conn)
+
+    #The maintenance, in bulk sql. They are called without concurrency.
+
+    # return [(level, count, bytes), ...]
+    def getStats(self):
+        sql = "SELECT zoom_level, COUNT(*), SUM(LENGTH(tile_data)) FROM tiles GROUP BY zoom_level ORDER BY zoom_level"
+        return self.__conn.execute(sql).fetchall()
+
+    # return the bytes of the tile data stored, which is less than the sum of the tiles if deduplicated
+    def getStoredBytes(self):
+        sql = "SELECT SUM(LENGTH(tile_data)) FROM %s" % ("images" if self.__is_dedup else "tiles",)
+        return self.__conn.execute(sql).fetchone()[0] or 0
+
+    # return if the deduplicated layout
+    def isDedup(self):
+        return self.__is_dedup
+
+    # return the bytes of the db file
+    def getFileBytes(self):
+        return sum(os.path.getsize(path) for path in (self.__db_path, self.__db_path + "-wal") if os.path.exists(path))
+
+    #delete the rows refer to the deleted tiles
+    def __deleteOrphans(self):
+        conn = self.__conn
+        table = "map" if self.__is_dedup else "tiles"
+        def exists_sql(tbl):
+            return "EXISTS (SELECT 1 FROM %s t WHERE t.zoom_level=%s.zoom_level AND t.tile_column=%s.tile_column AND t.tile_row=%s.tile_row)" % \
+                    (table, tbl, tbl, tbl)
+        def has_table(tbl):
+            return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (tbl,)).fetchone() is not None
+        if not self.__is_dedup and has_table("map"):
+            #the migration is paused, not to restore the deleted tiles when resumed
+            conn.execute("DELETE FROM map WHERE NOT " + exists_sql("map"))
+        if has_table("images"):
+            conn.execute("DELETE FROM images WHERE NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id=images.tile_id)")
+        if self.__has_meta:
+            conn.execute("DELETE FROM tiles_meta WHERE NOT " + exists_sql("tiles_meta"))
+        if self.__has_access:
+            conn.execute("DELETE FROM tiles_access WHERE NOT " + exists_sql("tiles_access"))
+
+    # delete the tiles older than @expire_sec, return the count
+    def purgeExpired(self, expire_sec):
+        if not self.__has_timestamp:
+            return 0
+        before = int(time.time()) - expire_sec
+        table = "map" if self.__is_dedup else "tiles"
+        with self.__conn:
+            count = self.__conn.execute("DELETE FROM %s WHERE timestamp < ?" % (table,), (before,)).rowcount
+            self.__deleteOrphans()
+        logging.info("[%s] Purge %d tiles before %d" % (self.map_id, count, before))
+        return count
+
+    #the last access time of the tiles, by the access record or the writing timestamp
+    #return (the expression of the access time, the from clause)
+    def __genAccessSql(self):
+        table = "map" if self.__is_dedup else "tiles"
+        ts_col = "t.timestamp" if self.__has_timestamp else "0"
+        if not self.__has_access:
+            return ts_col, "FROM %s t" % (table,)
+        return "COALESCE(a.access, %s)" % (ts_col,), \
+               "FROM %s t LEFT JOIN tiles_access a USING (zoom_level, tile_column, tile_row)" % (table,)
+
+    # return {bucket: bytes} of the tile data by the last access time, the bucket is the begin time of the ACCESS_BUCKET.
+    # for the deduplicated, the data is counted once by its latest access.
+    def getAccessHistogram(self):
+        access, from_clause = self.__genAccessSql()
+        b = self.ACCESS_BUCKET
+        if self.__is_dedup:
+            sql = "SELECT last / %d * %d AS bucket, SUM(LENGTH(i.tile_data)) FROM " % (b, b) + \
+                  "(SELECT t.tile_id AS tile_id, MAX(%s) AS last %s GROUP BY t.tile_id) " % (access, from_clause) + \
+                  "JOIN images i USING (tile_id) GROUP BY bucket"
+        else:
+            sql = "SELECT %s / %d * %d AS bucket, SUM(LENGTH(t.tile_data)) %s GROUP BY bucket" % (access, b, b, from_clause)
+        return dict(self.__conn.execute(sql).fetchall())
+
+    # delete the tiles not accessed since @ts, return the count
+    def evictBefore(self, ts):
+        access, from_clause = self.__genAccessSql()
+        if self.__is_dedup:
+            sql = "DELETE FROM map WHERE tile_id IN (SELECT t.tile_id %s GROUP BY t.tile_id HAVING MAX(%s) < ?)" % \
+                    (from_clause, access)
+        else:
+            sql = "DELETE FROM tiles WHERE rowid IN (SELECT t.rowid %s WHERE %s < ?)" % (from_clause, access)
+        with self.__conn:
+            count = self.__conn.execute(sql, (ts,)).rowcount
+            self.__deleteOrphans()
+        logging.info("[%s] Evict %d tiles not accessed since %d" % (self.map_id, count, ts))
+        return count
+
+    # reclaim the free pages, return the count.
+    # the incremental vacuum needs a full vacuum once for the db created before supporting it.
+    def vacuum(self, max_pages=0):
+        conn = self.__conn
+        count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:  #INCREMENTAL
+            logging.info("[%s] Vacuum fully to enable the incremental vacuum" % (self.map_id,))
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            conn.executescript("PRAGMA incremental_vacuum(%d);" % (max_pages,))  #execute() frees only one page
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return count - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    #the Surrogate thread, which writes the pending data
     def __runSurrogate(self):
-        def has_sql_events():
-            return self.__is_closed or len(self.__sql_queue)
+        def get_flush_timeout():
+            with self.__pending_lock:
+                return self.__getFlushTimeout()
+
+        def is_flush_needed():
+            with self.__pending_lock:
+                return self.__isFlushNeeded()
         
-        self.__start()
+        try:
+            self.__start()
+        finally:
+            self.__ready.set()
+
         try:
             while True:
-                #wait events
-                item = None
-                with self.__sql_queue_cv:
-                    self.__sql_queue_cv.wait_for(has_sql_events)
+                #wait events, or timeout to flush pending data
+                with self.__write_cv:
+                    while not (self.__is_closed or is_flush_needed() or self.__migrate_rowid is not None):
+                        self.__write_cv.wait(get_flush_timeout())
                     if self.__is_closed:
                         return
-                    item = self.__sql_queue.pop(0)
 
-                level, x, y, data = item
                 #put data
-                if data:
+                if is_flush_needed():
                     try:
-                        self.__put(level, x, y, data)
+                        self.__flush()
                     except Exception as ex:
                         logging.error("[%s] DB put data error: %s" % (self.map_id, str(ex)))
-                #get data
-                else:
-                    res_data, res_ex = None, None
+
+                #migrate a batch between the writes
+                if self.__migrate_rowid is not None:
                     try:
-                        res_data = self.__get(level, x, y)
-                        res_ex = None
+                        self.__migrateStep()
                     except Exception as ex:
-                        logging.error("[%s] DB get data error: %s" % (self.map_id, str(ex)))
-                        res_data = None
-                        res_ex = ex
-
-                    #notify
-                    with self.__get_respose_cv:
-                        self.__get_respose = (res_data, res_ex)
-                        self.__get_respose_cv.notify()
+                        logging.error("[%s] Migrate to the dedup layout error: %s" % (self.map_id, str(ex)))
+                        self.__migrate_rowid = None  #stay in the flat layout, and retry next time
 
         finally:
-            self.__close()
+            self.__close()  #flush pending data
 
 if __name__ == '__main__':
     desc = MapDescriptor.parseXml("mapcache/TM25K_2001.xml")
@@ -217,6 +217,41 @@ def imageIsTransparent(img):
         return True
     return False
 
+def readPolygon(path):
+    """ read the polygon from a text file, one 'lat,lon' each line.
+        the empty lines and the lines starting with '#' are ignored. """
+    polygon = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            lat, lon = line.replace(',', ' ').split()
+            polygon.append((float(lat), float(lon)))
+    if len(polygon) < 3:
+        raise ValueError("the polygon needs 3 points at least")
+    return polygon
+
+def clipSegment(x0, y0, x1, y1, rect):
+    """ clip the segment (x0, y0)-(x1, y1) by the rect (left, upper, right, lower), by Liang-Barsky.
+        return the clipped (x0, y0, x1, y1), or None if the segment is out of the rect. """
+    left, upper, right, lower = rect
+    dx, dy = x1 - x0, y1 - y0
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x0 - left), (dx, right - x0), (-dy, y0 - upper), (dy, lower - y0)):
+        if p == 0:
+            if q < 0:
+                return None  #parallel to the edge, and outside
+            continue
+        t = q / p
+        if p < 0:
+            if t > t1: return None
+            t0 = max(t0, t)
+        else:
+            if t < t0: return None
+            t1 = min(t1, t)
+    return (x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy)
+
 def saveXml(xml_root, filepath, enc="UTF-8"):
     #no fromat
     #tree = ET.ElementTree(element=root)
@@ -0,0 +1,125 @@
+import pytest
+
+import src.conf as conf
+import src.tile as tile
+from src.tile import HostHealth
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(tile.time, 'time', lambda: now[0])
+    monkeypatch.setattr(conf, 'DL_HOST_RATE', 0)
+    monkeypatch.setattr(conf, 'DL_BREAKER_FAILS', 3)
+    monkeypatch.setattr(conf, 'DL_BREAKER_DELAY', 10)
+    monkeypatch.setattr(conf, 'DL_BREAKER_MAX_DELAY', 100)
+    return now
+
+
+def acquireMany(health, n):
+    tickets = []
+    for i in range(n):
+        wait_time, ticket = health.acquire()
+        assert wait_time == 0
+        tickets.append(ticket)
+    return tickets
+
+
+def openCircuit(health, clock):
+    tickets = acquireMany(health, conf.DL_BREAKER_FAILS + 2)
+    for ticket in tickets[:conf.DL_BREAKER_FAILS]:
+        health.report(False, ticket)
+    assert health.state == HostHealth.OPEN
+    clock[0] += conf.DL_BREAKER_DELAY
+    return tickets[conf.DL_BREAKER_FAILS:]  #still in flight
+
+
+class TestHostHealth:
+    def test_open_after_failures(self, clock):
+        health = HostHealth('host')
+        t1, t2, t3 = acquireMany(health, 3)
+        assert not health.report(False, t1)
+        assert not health.report(False, t2)
+        assert health.report(False, t3)
+        assert health.state == HostHealth.OPEN
+        assert health.acquire() == (None, None)
+        assert health.getOpenTime() == conf.DL_BREAKER_DELAY
+
+    def test_success_resets_failures(self, clock):
+        health = HostHealth('host')
+        t1, t2, t3, t4 = acquireMany(health, 4)
+        health.report(False, t1)
+        health.report(False, t2)
+        health.report(True, t3)
+        assert not health.report(False, t4)
+        assert health.state == HostHealth.CLOSED
+
+    def test_one_probe_when_half_open(self, clock):
+        health = HostHealth('host')
+        openCircuit(health, clock)
+        wait_time, probe = health.acquire()
+        assert wait_time == 0
+        assert health.state == HostHealth.HALF_OPEN
+        assert health.acquire() == (None, None)
+        assert health.getOpenTime() == 0
+
+    def test_probe_success_closes(self, clock):
+        health = HostHealth('host')
+        openCircuit(health, clock)
+        wait_time, probe = health.acquire()
+        assert health.report(True, probe)
+        assert health.state == HostHealth.CLOSED
+        assert health.getOpenTime() is None
+        assert health.acquire()[0] == 0
+
+    def test_probe_failure_doubles_delay(self, clock):
+        health = HostHealth('host')
+        openCircuit(health, clock)
+        wait_time, probe = health.acquire()
+        assert health.report(False, probe)
+        assert health.state == HostHealth.OPEN
+        assert health.getOpenTime() == conf.DL_BREAKER_DELAY * 2
+
+    def test_stale_release_keeps_probe(self, clock):
+        health = HostHealth('host')
+        stale = openCircuit(health, clock)
+        wait_time, probe = health.acquire()
+        health.release(stale[0])
+        assert health.acquire() == (None, None)
+
+    def test_stale_reports_ignored(self, clock):
+        health = HostHealth('host')
+        stale = openCircuit(health, clock)
+        wait_time, probe = health.acquire()
+        assert not health.report(False, stale[0])
+        assert not health.report(True, stale[1])
+        assert health.state == HostHealth.HALF_OPEN
+        assert health.report(True, probe)
+        assert health.state == HostHealth.CLOSED
+
+    def test_stale_reports_ignored_when_open(self, clock):
+        health = HostHealth('host')
+        stale = openCircuit(health, clock)
+        clock[0] -= 1
+        assert not health.report(True, stale[0])
+        assert health.state == HostHealth.OPEN
+
+    def test_release_probe_without_report(self, clock):
+        health = HostHealth('host')
+        openCircuit(health, clock)
+        wait_time, probe = health.acquire()
+        health.release(probe)
+        assert health.state == HostHealth.HALF_OPEN
+        wait_time, probe2 = health.acquire()
+        assert wait_time == 0
+        assert health.acquire() == (None, None)
+
+    def test_token_bucket(self, clock, monkeypatch):
+        monkeypatch.setattr(conf, 'DL_HOST_RATE', 2)
+        health = HostHealth('host')
+        acquireMany(health, 2)
+        wait_time, ticket = health.acquire()
+        assert wait_time == pytest.approx(0.5)
+        assert ticket is None
+        clock[0] += 0.5
+        assert health.acquire()[0] == 0